@@ -21,7 +21,8 @@ from picopore.runner import PicoporeCompressionRunner
 __description = """See also:
 \tpicopore-realtime\tmonitors a directory for new reads and compresses them in real time
 \tpicopore-test\t\tcompresses to temporary files and checks that all datasets and attributes are equal (lossless modes only)
-\tpicopore-rename\t\trenames groups and datasets within FAST5 files"""
+\tpicopore-rename\t\trenames groups and datasets within FAST5 files
+\tpicopore-bench\t\treplicates sample files and reports the throughput of each mode as JSON"""
 
 def main():
     args = parseArgs(description=__description)
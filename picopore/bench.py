@@ -0,0 +1,146 @@
+"""
+    This file is part of Picopore.
+
+    Picopore is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Picopore is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Picopore.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import tempfile
+import multiprocessing
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+try:
+    import resource
+except ImportError:
+    # peak memory is not reported on windows
+    resource = None
+
+from picopore.version import __version__
+from picopore.parse_args import parseArgs, parseBenchArgs
+from picopore.runner import PicoporeCompressionRunner
+from picopore.util import findFast5, log
+
+__sample_pattern__ = os.path.join("sample_data", "*_original.fast5")
+
+def getRunnerArgs(directory, mode, revert, threads, chunk_size):
+    # parsed by picopore's own parser, so new options take their defaults
+    argv = ["-y", "--progress", "none", "--no-skip-compressed", "--mode", mode, "--threads", str(threads),
+            "--chunk-size", str(chunk_size)] + (["--revert"] if revert else []) + [directory]
+    return parseArgs(argv=argv)
+
+def getWorkerPeakRSS():
+    # largest peak resident memory of any finished child process
+    # ru_maxrss is in kilobytes on linux and bytes on mac
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak * (1 if sys.platform == "darwin" else 2**10)
+
+def _run(args, queue):
+    # run in a fresh process so that peak memory is measured for this run's workers only
+    sys.stdout = open(os.devnull, 'w')
+    runner = PicoporeCompressionRunner(args)
+    start = time.time()
+    runner.run()
+    elapsed = time.time() - start
+    runner.multiprocessor.pool.close()
+    runner.multiprocessor.pool.join()
+    queue.put((elapsed, runner.preSize, runner.postSize, runner.multiprocessor.errors, getWorkerPeakRSS()))
+
+def runBenchmark(directory, mode, revert, threads, chunk_size):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run, args=[getRunnerArgs(directory, mode, revert, threads, chunk_size), queue])
+    process.start()
+    while True:
+        try:
+            elapsed, preSize, postSize, errors, peakRSS = queue.get(timeout=1)
+            break
+        except Empty:
+            if not process.is_alive():
+                raise RuntimeError("Benchmark of {} mode exited with code {}".format(mode, process.exitcode))
+    process.join()
+    files = len(os.listdir(directory))
+    return {
+        "mode" : mode,
+        "revert" : revert,
+        "threads" : threads,
+        "files" : files,
+        "errors" : errors,
+        "seconds" : elapsed,
+        "files_per_second" : files / elapsed,
+        "mb_per_second" : preSize / elapsed / 2**20,
+        "input_bytes" : preSize,
+        "output_bytes" : postSize,
+        "compression_ratio" : float(postSize) / preSize if preSize > 0 else None,
+        "peak_rss_per_worker" : peakRSS,
+    }
+
+def replicate(samples, directory, n):
+    # fill directory with n copies of the samples, in turn
+    for filename in os.listdir(directory):
+        os.remove(os.path.join(directory, filename))
+    for i in range(n):
+        sample = samples[i % len(samples)]
+        shutil.copyfile(sample, os.path.join(directory, "{}_{}".format(i, os.path.basename(sample))))
+
+def benchmark(samples, directory, n, modes, threadCounts, chunk_size, verbose=True):
+    results = []
+    for threads in threadCounts:
+        for mode in modes:
+            replicate(samples, directory, n)
+            for revert in [False, True] if mode != "raw" else [False]:
+                if verbose:
+                    log("Benchmarking {}{} on {} files with {} threads".format(mode, " revert" if revert else "", n, threads))
+                results.append(runBenchmark(directory, mode, revert, threads, chunk_size))
+    return results
+
+__description = """picopore-bench replicates sample files and reports the throughput of each mode as JSON"""
+
+def main():
+    args = parseBenchArgs(description=__description)
+    samples = list(findFast5(args.input, False)) if len(args.input) > 0 else sorted(glob.glob(__sample_pattern__))
+    if len(samples) == 0:
+        log("No sample files found.")
+        return 1
+    if args.directory is None:
+        directory = tempfile.mkdtemp(prefix="picopore-bench.")
+    else:
+        directory = tempfile.mkdtemp(prefix="picopore-bench.", dir=args.directory)
+    try:
+        results = benchmark(samples, directory, args.files, args.mode, args.threads, args.chunk_size,
+                            verbose=args.output is not None)
+    finally:
+        shutil.rmtree(directory)
+    report = json.dumps({
+        "version" : __version__,
+        "samples" : samples,
+        "results" : results,
+    }, indent=2)
+    if args.output is None:
+        log(report)
+    else:
+        with open(args.output, 'w') as handle:
+            handle.write(report + "\n")
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -18,18 +18,19 @@ import subprocess
 import numpy as np
 import h5py
 import os
-from numpy.lib.recfunctions import drop_fields, append_fields
 from functools import partial
 
-from picopore.util import log, isGroup, getDtype, findDatasets, rewriteDataset, recursiveCollapseGroups, uncollapseGroups, getPrefixedFilename
+from picopore.util import log, isGroup, getDtype, getIntDtype, HDF5Index, compileKeywords, checkFilter, getH5repackArgs, rewriteDataset, rewriteFields, recursiveCollapseGroups, uncollapseGroups, escapeName, getPrefixedFilename, repack, ProcessingError, setAdaptiveShared
+from picopore.timing import stage
 
 __basegroup_name__ = "Picopore"
+__codec_attr__ = "picopore.codec"
 __raw_compress_keywords__ = ["Alignment","Log","Configuration","HairpinAlign","Calibration_Strand","Hairpin_Split","EventDetection","Events","Segmentation"]
 __raw_compress_summary__ = ["Summary"]
 __raw_compress_fastq__ = ["BaseCalled"]
 __raw_compress_fastq_summary__ = ["Basecall"]
 
-def chooseCompressFunc(revert, mode, fastq, summary, manual, realtime=False):
+def chooseCompressFunc(revert, mode, fastq, summary, manual, realtime=False, codec=None):
     name = "Performing "
     if realtime:
         name += "real time "
@@ -51,96 +52,241 @@ def chooseCompressFunc(revert, mode, fastq, summary, manual, realtime=False):
             func = deepLosslessCompress
             name += "deep lossless compression"
         elif mode == 'raw':
-            name += "raw compression "
-            if manual is not None:
-                name += "with manual keyword " + manual
-                keywords = [manual]
-            else:
-                keywords = __raw_compress_keywords__
-                if fastq and summary:
-                    name += "with FASTQ and summary"
-                elif fastq:
-                    keywords += __raw_compress_summary__
-                    name += "with FASTQ and no summary"
-                elif summary:
-                    keywords += __raw_compress_fastq__
-                    name += "with summary and no FASTQ"
-                else:
-                    keywords += __raw_compress_fastq_summary__
-                    name += "with no summary and no FASTQ"
-            func = partial(rawCompress, keywords=keywords)
+            keywords, description = getRawKeywords(fastq, summary, manual)
+            name += "raw compression " + description
+            func = partial(rawCompress, pattern=compileKeywords(keywords))
+    if codec is not None and not revert:
+        name += " using {}".format(codec)
+    else:
+        codec = None
     try:
-        return partial(compress, func), name
+        return partial(compress, func, codec=codec), name
     except NameError:
         log("No compression method selected")
         exit(1)
 
+def getRawKeywords(fastq, summary, manual):
+    if manual is not None:
+        return [manual], "with manual keyword " + manual
+    keywords = list(__raw_compress_keywords__)
+    if fastq and summary:
+        description = "with FASTQ and summary"
+    elif fastq:
+        keywords += __raw_compress_summary__
+        description = "with FASTQ and no summary"
+    elif summary:
+        keywords += __raw_compress_fastq__
+        description = "with summary and no FASTQ"
+    else:
+        keywords += __raw_compress_fastq_summary__
+        description = "with no summary and no FASTQ"
+    return keywords, description
+
+def chooseCheckFunc(revert, mode, fastq, summary, manual, codec=None):
+    # functions reporting whether a file is already in the state the chosen mode produces
+    if revert:
+        if mode in ['lossless', 'deep-lossless']:
+            return isLosslessDecompressed
+    else:
+        if mode == 'lossless':
+            return partial(isLosslessCompressed, codec=codec)
+        elif mode == 'deep-lossless':
+            return partial(isDeepLosslessCompressed, codec=codec)
+        elif mode == 'raw':
+            keywords, _ = getRawKeywords(fastq, summary, manual)
+            return partial(isRawCompressed, pattern=compileKeywords(keywords), codec=codec)
+    return None
+
+def checkCompressed(check, filename, group="all"):
+    # reads only the file's metadata, not its datasets
+    try:
+        with h5py.File(filename, 'r') as f:
+            return check(f, group)
+    except Exception:
+        # let compress report the problem
+        return False
+
+def hasFilter(f, index, paths, level):
+    datasets = [path for path in paths if index.kinds[path] == "Dataset"]
+    return len(datasets) > 0 and all([f[path].compression == "gzip" and f[path].compression_opts == level for path in datasets])
+
+def getCodec(f):
+    codec = f.attrs.get(__codec_attr__)
+    return codec.decode() if isinstance(codec, bytes) else codec
+
+def hasCodec(f, index, paths, codec):
+    # files written with the default filter have no codec recorded
+    if codec is None:
+        return getCodec(f) is None and hasFilter(f, index, paths, 9)
+    return getCodec(f) == codec
+
+def isLosslessCompressed(f, group, codec=None):
+    if __basegroup_name__ in f:
+        # deep lossless compression includes lossless compression
+        return getCodec(f) == codec
+    index = HDF5Index(f)
+    return hasCodec(f, index, getLosslessPaths(index, group), codec)
+
+def isLosslessDecompressed(f, group):
+    if __basegroup_name__ in f or getCodec(f) is not None:
+        return False
+    index = HDF5Index(f)
+    return hasFilter(f, index, getLosslessPaths(index, group), 1)
+
+def isDeepLosslessCompressed(f, group, codec=None):
+    return __basegroup_name__ in f and getCodec(f) == codec
+
+def isRawCompressed(f, group, pattern, codec=None):
+    if __basegroup_name__ in f:
+        return False
+    index = HDF5Index(f)
+    if len(index.findOutermost(group, keyword=pattern)) > 0:
+        return False
+    return hasCodec(f, index, index.find("all", keyword="Signal", entry_point="Raw"), codec)
+
+def setCodec(f, codec):
+    # record non-default filters so that they can be checked for when reading or reverting
+    if codec is not None:
+        f.attrs[__codec_attr__] = codec
+    elif __codec_attr__ in f.attrs:
+        del f.attrs[__codec_attr__]
+
 def indexToZero(f, path, col, name="picopore.{}_index", dataColumn=None):
     dataset = f[path]
     name = name.format(col)
     data = f[path].value
     if not name in dataset.attrs.keys():
         dataColumn = data[col] if dataColumn is None else dataColumn
-        start_index = min(dataColumn)
+        dataColumn, start_index = rebaseColumn(dataColumn)
         dataset.attrs.create(name, start_index, dtype=getDtype(start_index))
-        dataColumn = dataColumn-start_index
-        data = drop_fields(data, [col])
-        data = append_fields(data, [col], [dataColumn], [getDtype(dataColumn)])
+        data = rewriteFields(data, [col], [dataColumn])
     return data
 
+def rebaseColumn(column):
+    # shift a column to start at zero and narrow it, without a second pass to type it
+    start_index = column.min()
+    if column.dtype.kind in 'iu':
+        # the rebased column starts at zero, so its type depends only on its maximum
+        rebased = np.empty(column.shape, dtype=getIntDtype(column.max() - start_index))
+        np.subtract(column, start_index, out=rebased, casting='unsafe')
+    else:
+        rebased = column - start_index
+        rebased = rebased.astype(getDtype(rebased))
+    return rebased, start_index
+
+def deltaEncode(f, path, col=None, name="picopore.{}_delta", data=None):
+    # store differences between neighbouring values, keeping the first value as an attribute
+    dataset = f[path]
+    name = name.format("value" if col is None else col)
+    data = dataset[()] if data is None else data
+    column = data if col is None else data[col]
+    if name not in dataset.attrs.keys() and column.dtype.kind in 'iu' and column.shape[0] > 0:
+        deltas, first = deltaColumn(column)
+        dataset.attrs.create(name, first, dtype=column.dtype)
+        data = deltas if col is None else rewriteFields(data, [col], [deltas])
+    return data
+
+def deltaDecode(f, path, col=None, name="picopore.{}_delta", data=None):
+    dataset = f[path]
+    name = name.format("value" if col is None else col)
+    data = dataset[()] if data is None else data
+    if name in dataset.attrs.keys():
+        column = undeltaColumn(data if col is None else data[col], dataset.attrs[name])
+        del dataset.attrs[name]
+        data = column if col is None else rewriteFields(data, [col], [column])
+    return data
+
+def deltaColumn(column):
+    # slowly varying columns have small differences, which narrow and compress better than the values
+    deltas = np.empty(column.shape, dtype='int64')
+    deltas[0] = 0
+    np.subtract(column[1:], column[:-1], out=deltas[1:], casting='unsafe')
+    return deltas.astype(getDtype(deltas)), column[0]
+
+def undeltaColumn(deltas, first):
+    column = np.cumsum(deltas, dtype='int64')
+    column += first
+    return column.astype(getDtype(column))
+
+def toSampleIndex(column, sampleRate):
+    # equivalent to int(round(sampleRate * i)) for each i in column
+    index = column.astype('float64')
+    index *= sampleRate
+    return np.rint(index, out=index).astype('int64')
+
+def matchEvents(eventData, start):
+    # select the event detection events at each basecalled start time; both are sorted by start
+    keepIndex = np.searchsorted(eventData["start"], start)
+    if np.any(keepIndex >= eventData.shape[0]) or np.any(eventData["start"][keepIndex] != start):
+        raise ValueError("Basecalled events not found in event detection")
+    return eventData[keepIndex]
+
 def deepLosslessCompress(f, group):
-    paths = findDatasets(f, group, "Events")
+    index = HDF5Index(f)
+    paths = index.find(group, "Events")
     paths = [path for path in paths if "Basecall" in path]
     # index event detection
     if "UniqueGlobalKey/channel_id" in f:
         sampleRate = f["UniqueGlobalKey/channel_id"].attrs["sampling_rate"]
         for path in paths:
-            if f[path].parent.parent.attrs.__contains__("event_detection"):
+            basecallAttrs = index.attrs(index.parent(path, 2))
+            if "event_detection" in basecallAttrs:
                 # index back to event detection
                 dataset = f[path].value
-                start = np.array([int(round(sampleRate * i)) for i in dataset["start"]])
+                start = toSampleIndex(dataset["start"], sampleRate)
                 dataset = indexToZero(f, path, "start", dataColumn=start)
+                dataset = deltaEncode(f, path, "start", data=dataset)
                 move = dataset["move"] # rewrite move dataset because it's int64 for max 2
                 # otherwise, event by event
-                dataset = drop_fields(dataset, ["mean", "stdv", "length", "move"])
-                dataset = append_fields(dataset, ["move"], [move], [getDtype(move)])
+                dataset = rewriteFields(dataset, ["move"], [move], [getDtype(move)], drop=["mean", "stdv", "length"])
                 rewriteDataset(f, path, compression="gzip", compression_opts=9, dataset=dataset)
                 # rewrite eventdetection too - start is also way too big here
-                eventDetectionPath = findDatasets(f, "all", entry_point=f[path].parent.parent.attrs.get("event_detection"))[0]
+                eventDetectionPath = index.find("all", entry_point=basecallAttrs["event_detection"])[0]
                 if "picopore.start_index" not in f[eventDetectionPath].attrs.keys():
                     eventData = indexToZero(f, eventDetectionPath, "start")
+                    eventData = deltaEncode(f, eventDetectionPath, "start", data=eventData)
                     rewriteDataset(f, eventDetectionPath, compression="gzip", compression_opts=9, dataset=eventData)
+    # raw signal varies slowly from sample to sample
+    for path in index.find("all", keyword="Signal", entry_point="Raw"):
+        rewriteDataset(f, path, compression="gzip", compression_opts=9, dataset=deltaEncode(f, path))
 
     if __basegroup_name__ not in f:
         f.create_group(__basegroup_name__)
         for name, group in f.items():
             if name != __basegroup_name__:
-                recursiveCollapseGroups(f, __basegroup_name__, name, group)
+                recursiveCollapseGroups(f, __basegroup_name__, escapeName(name), group)
     return losslessCompress(f, group)
 
 def deepLosslessDecompress(f, group):
     # rebuild group hierarchy
     if __basegroup_name__ in f.keys():
         uncollapseGroups(f, f[__basegroup_name__])
-    paths = findDatasets(f, group)
+    index = HDF5Index(f)
+    for path in index.find("all", keyword="Signal", entry_point="Raw"):
+        if "picopore.value_delta" in f[path].attrs.keys():
+            rewriteDataset(f, path, dataset=deltaDecode(f, path))
+    paths = index.find(group)
     paths = [path for path in paths if "Basecall" in path]
     sampleRate = f["UniqueGlobalKey/channel_id"].attrs["sampling_rate"]
     for path in paths:
-        if f[path].parent.parent.attrs.__contains__("event_detection"):
+        basecallAttrs = index.attrs(index.parent(path, 2))
+        if "event_detection" in basecallAttrs:
             # index back to event detection
             dataset = f[path].value
             if "mean" not in dataset.dtype.names:
-                eventDetectionPath = findDatasets(f, "all", entry_point=f[path].parent.parent.attrs.get("event_detection"))[0]
+                eventDetectionPath = index.find("all", entry_point=basecallAttrs["event_detection"])[0]
                 eventData = f[eventDetectionPath].value
                 try:
-                    start = eventData["start"] + f[eventDetectionPath].attrs["picopore.start_index"]
+                    start_index = f[eventDetectionPath].attrs["picopore.start_index"]
+                    eventData = deltaDecode(f, eventDetectionPath, "start", data=eventData)
+                    start = eventData["start"] + start_index
                     del f[eventDetectionPath].attrs["picopore.start_index"]
-                    eventData = drop_fields(eventData, ["start"])
-                    eventData = append_fields(eventData, ["start"], [start], [getDtype(start)])
+                    eventData = rewriteFields(eventData, ["start"], [start], [getDtype(start)])
                     rewriteDataset(f, eventDetectionPath, compression="gzip", compression_opts=1, dataset=eventData)
                 except KeyError:
                     # must have been compressed without start indexing
                     pass
+                dataset = deltaDecode(f, path, "start", data=dataset)
                 try:
                     start_index = f[path].attrs["picopore.start_index"]
                     del f[path].attrs["picopore.start_index"]
@@ -152,46 +298,36 @@ def deepLosslessDecompress(f, group):
                 # constrain to range in basecall
                 eventData = eventData[np.logical_and(eventData["start"] >= start, eventData["start"] <= end)]
                 # remove missing events
-                i=0
-                keepIndex = []
-                for time in dataset["start"]:
-                    while eventData["start"][i] != time + start_index and i < eventData.shape[0]:
-                        i += 1
-                    keepIndex.append(i)
-                eventData = eventData[keepIndex]
-                dataset = drop_fields(dataset, "start")
-                start = [i/sampleRate for i in eventData["start"]]
-                length = [i/sampleRate for i in eventData["length"]]
-                dataset = append_fields(dataset, ["mean", "start", "stdv", "length"], [eventData["mean"], start, eventData["stdv"], length])
+                eventData = matchEvents(eventData, dataset["start"].astype('int64') + int(start_index))
+                start = eventData["start"] / sampleRate
+                length = eventData["length"] / sampleRate
+                dataset = rewriteFields(dataset, ["mean", "start", "stdv", "length"], [eventData["mean"], start, eventData["stdv"], length])
                 rewriteDataset(f, path, dataset=dataset)
     return losslessDecompress(f, group)
 
+def getLosslessPaths(index, group):
+    paths = index.find(group, keyword="Events")
+    paths.extend(index.find(group, keyword="Alignment"))
+    paths.extend(index.find("all", keyword="Signal", entry_point="Raw"))
+    return paths
+
 def losslessCompress(f, group):
-    paths = findDatasets(f, group, keyword="Events")
-    paths.extend(findDatasets(f, group, keyword="Alignment"))
-    paths.extend(findDatasets(f, "all", keyword="Signal", entry_point="Raw"))
-    for path in paths:
+    for path in getLosslessPaths(HDF5Index(f), group):
         rewriteDataset(f, path, "gzip", 9)
     return "GZIP=9"
 
 def losslessDecompress(f, group):
-    paths = findDatasets(f, group, keyword="Events")
-    paths.extend(findDatasets(f, group, keyword="Alignment"))
-    paths.extend(findDatasets(f, "all", keyword="Signal", entry_point="Raw"))
-    for path in paths:
+    for path in getLosslessPaths(HDF5Index(f), group):
         rewriteDataset(f, path)
     return "GZIP=1"
 
-def rawCompress(f, group, keywords):
+def rawCompress(f, group, pattern):
     if "Picopore" in f:
         log("{} is compressed using picopore deep-lossless compression. Please use picpore --revert --mode deep-lossless before attempting raw compression.".format(f.filename))
     else:
-        paths = []
-        for kw in keywords:
-            paths.extend(findDatasets(f, group, keyword=kw))
-        for path in paths:
-            if path in f:
-                del f[path]
+        # deleting a group deletes its children, so only the outermost matches are needed
+        for path in HDF5Index(f).findOutermost(group, keyword=pattern):
+            del f[path]
         try:
             if len(f["Analyses"].keys()) == 0:
                 del f["Analyses"]
@@ -200,15 +336,44 @@ def rawCompress(f, group, keywords):
             pass
     return "GZIP=9"
 
-def compress(func, filename, group="all"):
+def compress(func, filename, group="all", h5repack=False, journal=None, codec=None, chunkPolicy=None, adaptiveShared=None):
+    if adaptiveShared is not None:
+        setAdaptiveShared(*adaptiveShared)
     try:
-        with h5py.File(filename, 'r+') as f:
-            filtr = func(f, group)
-        subprocess.call(["h5repack","-f",filtr,filename, "{}.tmp".format(filename)])
-        subprocess.call(["mv","{}.tmp".format(filename),filename])
+        if h5repack:
+            with h5py.File(filename, 'r+') as f:
+                with stage("rewrite"):
+                    filtr = func(f, group)
+                filtr = filtr if codec is None else codec
+                setCodec(f, codec)
+            with stage("h5repack"):
+                subprocess.call(["h5repack"] + getH5repackArgs(filtr) + [filename, "{}.tmp".format(filename)])
+            with stage("mv"):
+                subprocess.call(["mv","{}.tmp".format(filename),filename])
+        else:
+            # edit an in-memory image and write it to disk once, with its final filter
+            # the original is only replaced once the output has been written successfully
+            with stage("read"):
+                f = h5py.File(filename, 'r+', driver='core', backing_store=False)
+            with f:
+                if getCodec(f) is not None:
+                    # fail early if the filters needed to read the file are unavailable
+                    checkFilter(getCodec(f))
+                with stage("rewrite"):
+                    filtr = func(f, group)
+                filtr = filtr if codec is None else codec
+                setCodec(f, codec)
+                with stage("write"):
+                    repack(filename, filtr, src=f, chunkPolicy=chunkPolicy)
+        if journal is not None:
+            with stage("journal"):
+                journal.record(filename, "OK")
         return os.path.getsize(filename)
     except Exception as e:
         log("ERROR: {} on file {}".format(str(e), filename))
         if os.path.isfile("{}.tmp".format(filename)):
             os.remove("{}.tmp".format(filename))
-        return os.path.getsize(filename)
+        if journal is not None:
+            journal.record(filename, "ERROR")
+        # the original is untouched: count its size, and the failure
+        raise ProcessingError(str(e), os.path.getsize(filename))
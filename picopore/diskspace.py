@@ -0,0 +1,87 @@
+"""
+    This file is part of Picopore.
+
+    Picopore is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Picopore is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Picopore.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import time
+import threading
+
+from picopore.util import log
+
+def getFreeSpace(path):
+    stat = os.statvfs(os.path.dirname(os.path.abspath(path)))
+    return stat.f_bavail * stat.f_frsize
+
+class DiskSpaceThrottle(object):
+    # admits chunks of files to the workers only while the space their output needs is free
+    # each filesystem keeps minFree bytes free, less the space reserved by chunks in flight
+    # expansion is the output size relative to the input; when cumulative is False, each file
+    # replaces its input before the next in the chunk starts, so a chunk needs only its largest file
+
+    def __init__(self, minFree=0, expansion=1, cumulative=False):
+        self.minFree = minFree
+        self.expansion = expansion
+        self.cumulative = cumulative
+        # filesystem device -> bytes reserved by chunks in flight
+        self.reserved = {}
+        # id of chunk in flight -> [(device, bytes)]
+        self.inFlight = {}
+        # log waits at most every logInterval seconds
+        self.logInterval = 60
+        self.lastLog = 0
+        self.lock = threading.Lock()
+
+    def estimate(self, chunk):
+        # space needed by a chunk on each filesystem, and a path on that filesystem
+        needed, paths = {}, {}
+        for filename in chunk:
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                # let the worker report the missing file
+                continue
+            size = int(stat.st_size * self.expansion)
+            if self.cumulative:
+                needed[stat.st_dev] = needed.get(stat.st_dev, 0) + size
+            else:
+                needed[stat.st_dev] = max(needed.get(stat.st_dev, 0), size)
+            paths.setdefault(stat.st_dev, filename)
+        return needed, paths
+
+    def admit(self, chunk):
+        needed, paths = self.estimate(chunk)
+        with self.lock:
+            for device, size in needed.items():
+                reserved = self.reserved.get(device, 0)
+                # with nothing in flight, always admit the chunk so that processing continues
+                if reserved > 0:
+                    free = getFreeSpace(paths[device])
+                    if free - reserved - size < self.minFree:
+                        if time.time() - self.lastLog >= self.logInterval:
+                            log("Waiting for disk space: {:.1f} MB free on {}, {:.1f} MB in flight".format(
+                                free / 2.0**20, os.path.dirname(os.path.abspath(paths[device])), reserved / 2.0**20))
+                            self.lastLog = time.time()
+                        return False
+            for device, size in needed.items():
+                self.reserved[device] = self.reserved.get(device, 0) + size
+            self.inFlight[id(chunk)] = list(needed.items())
+        return True
+
+    def release(self, chunk):
+        with self.lock:
+            for device, size in self.inFlight.pop(id(chunk), []):
+                self.reserved[device] -= size
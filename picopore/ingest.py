@@ -0,0 +1,111 @@
+"""
+    This file is part of Picopore.
+
+    Picopore is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Picopore is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Picopore.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import time
+import threading
+from collections import OrderedDict
+import h5py
+
+from picopore.util import log
+
+def isReadable(path):
+    # a file still being written usually fails to open as HDF5
+    try:
+        with h5py.File(path, 'r'):
+            return True
+    except Exception:
+        return False
+
+class IngestQueue(object):
+    # files announced in real time wait here until they have stopped changing,
+    # then are passed to the runner in batches
+
+    def __init__(self, runner, quietPeriod=5, batchSize=16, maxQueued=10000):
+        self.runner = runner
+        self.quietPeriod = quietPeriod
+        self.batchSize = batchSize
+        self.maxQueued = maxQueued
+        # path -> [size, mtime, time of last change], in order of arrival
+        self.pending = OrderedDict()
+        # recently dispatched paths, so repeated events for a file are ignored
+        self.recent = OrderedDict()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, path):
+        with self.condition:
+            if path in self.pending or path in self.recent:
+                return
+            # backpressure: hold up the watcher rather than queue without limit
+            while len(self.pending) >= self.maxQueued and self.running:
+                self.condition.wait(1)
+            self.pending[path] = [None, None, time.time()]
+
+    def poll(self):
+        now = time.time()
+        ready = []
+        with self.condition:
+            items = list(self.pending.items())
+        for path, state in items:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # deleted or moved away before it was complete
+                with self.condition:
+                    self.pending.pop(path, None)
+                continue
+            if state[0] != stat.st_size or state[1] != stat.st_mtime:
+                state[:] = [stat.st_size, stat.st_mtime, now]
+            elif now - state[2] >= self.quietPeriod:
+                if isReadable(path):
+                    ready.append(path)
+                else:
+                    # unchanged but not yet valid HDF5: wait another quiet period
+                    state[2] = now
+        with self.condition:
+            for path in ready:
+                del self.pending[path]
+                self.recent[path] = True
+            while len(self.recent) > self.maxQueued:
+                self.recent.popitem(last=False)
+            self.condition.notify_all()
+        for i in range(0, len(ready), self.batchSize):
+            # blocks while the pool is busy
+            self.runner.dispatch(ready[i:i + self.batchSize])
+
+    def run(self):
+        while self.running:
+            self.poll()
+            time.sleep(min(1, max(self.quietPeriod / 2.0, 0.1)))
+
+    def stop(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        if len(self.pending) > 0:
+            log("{} files still being written were not processed.".format(len(self.pending)))
@@ -0,0 +1,65 @@
+"""
+    This file is part of Picopore.
+
+    Picopore is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Picopore is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Picopore.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+
+from picopore.util import log
+
+class Journal(object):
+    # append-only record of processed files, one tab-separated line per file:
+    # path, mtime, size, mode, result
+    # lines are written by the worker processes, each in a single append
+
+    def __init__(self, filename, mode):
+        self.filename = filename
+        self.mode = mode
+        self.entries = {}
+
+    def record(self, path, result):
+        stat = os.stat(path)
+        line = "\t".join([path, repr(stat.st_mtime), str(stat.st_size), self.mode, result])
+        with open(self.filename, 'a') as handle:
+            handle.write(line + "\n")
+
+    def load(self):
+        # later entries for the same path replace earlier ones
+        self.entries = {}
+        try:
+            with open(self.filename, 'r') as handle:
+                for line in handle:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) == 5:
+                        self.entries[fields[0]] = fields[1:]
+        except IOError:
+            # no journal yet, nothing to resume
+            pass
+        log("Loaded {} entries from journal {}".format(len(self.entries), self.filename))
+        return self.entries
+
+    def isComplete(self, path):
+        # complete if processed successfully in this mode and unchanged since
+        try:
+            mtime, size, mode, result = self.entries[path]
+        except KeyError:
+            return False
+        if mode != self.mode or result != "OK":
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return float(mtime) == stat.st_mtime and int(size) == stat.st_size
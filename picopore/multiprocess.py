@@ -21,43 +21,168 @@
 
 import multiprocessing
 import signal
+import threading
+
+from picopore.util import log, ProcessingError, SkippedFile
+from picopore import timing
 
 def init_worker():
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
+def _process_chunk(func, chunk):
+    # aggregate results in the worker so only one result per chunk is returned
+    total, errors, skipped = 0, 0, []
+    for arg in chunk:
+        try:
+            total += func(arg)
+        except SkippedFile:
+            skipped.append(arg)
+        except ProcessingError as e:
+            total += e.result
+            errors += 1
+        except Exception as e:
+            log("ERROR: {} on {}".format(str(e), arg))
+            errors += 1
+    timing.dumpProfile()
+    return total, len(chunk), errors, skipped, timing.drain()
+
 class Multiprocessor:
 
-    def __init__(self, threads):
+    def __init__(self, threads, chunksize=1, callback=None):
         self.pool = self.init_pool(threads)
-        self.results = []
+        self.threads = threads
+        self.chunksize = chunksize
+        # bound the number of queued chunks so parent memory is independent of the number of files
+        self.maxPending = 2 * threads
+        # chunks are submitted in a fast lane or a background lane; background chunks only
+        # run on backlogSlots workers while fast chunks are waiting, and never queue behind them
+        self.backlogSlots = threads
+        self.pending = []
+        # set by the pool whenever a chunk finishes
+        self.finished = threading.Event()
+        # once set, no more chunks are submitted
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        # results may be collected from the watcher and main threads at once
+        # reentrant, as the callback may update counters that the runner also guards with it
+        self.foldLock = threading.RLock()
+        self.total = 0
+        self.processed = 0
+        self.errors = 0
+        # called in the parent with each finished chunk and its results
+        self.callback = callback
+        # optionally holds chunks back until there is disk space for their output
+        self.throttle = None
+
+    def reset(self):
+        # start the running totals again, e.g. between runs on one pool
+        with self.foldLock:
+            self.total = 0
+            self.processed = 0
+            self.errors = 0
 
     def init_pool(self, threads):
         return multiprocessing.Pool(threads, init_worker)
 
-    def apply_async(self, func, argList):
+    def setBacklogShare(self, share):
+        # fraction of workers kept for the background lane while the fast lane is busy
+        self.backlogSlots = int(round(share * self.threads))
+
+    def collect(self, block=False):
+        # fold finished chunks into the running totals and release them
+        with self.lock:
+            finished = [p for p in self.pending if block or p[1].ready()]
+            self.pending = [p for p in self.pending if p not in finished]
+        for chunk, r, background in finished:
+            total, processed, errors, skipped, records = r.get()
+            if self.throttle is not None:
+                self.throttle.release(chunk)
+            with self.foldLock:
+                self.total += total
+                self.processed += processed - len(skipped)
+                self.errors += errors
+                if self.callback is not None:
+                    self.callback(chunk, total, processed, errors, skipped, records)
+
+    def countPending(self, background):
+        return len([p for p in self.pending if p[2] == background])
+
+    def isFull(self, background):
+        if not background:
+            return self.countPending(False) >= self.maxPending
+        elif self.countPending(False) > 0:
+            return self.countPending(True) >= self.backlogSlots
+        else:
+            # the pool queue is first in first out, so keep no background chunks waiting in it
+            return self.countPending(True) >= self.threads
+
+    def isAdmitted(self, chunk, background):
+        return not self.isFull(background) and (self.throttle is None or self.throttle.admit(chunk))
+
+    def cancel(self):
+        # stop submitting chunks; those already submitted still finish
+        self.cancelled.set()
+        self.finished.set()
+
+    def submit(self, func, chunk, background=False):
+        while not self.cancelled.is_set() and not self.isAdmitted(chunk, background):
+            self.finished.wait(1)
+            self.finished.clear()
+            self.collect()
+        if self.cancelled.is_set():
+            return False
+        with self.lock:
+            self.pending.append((chunk, self.pool.apply_async(_process_chunk, args=[func, chunk],
+                                                              callback=lambda result: self.finished.set()), background))
+        return True
+
+    def apply_async(self, func, argList, background=False):
+        # argList may be a generator: start with small chunks so no thread waits on a full chunk
+        # returns the arguments taken from argList but not submitted, once cancelled
+        chunksize = 1
+        chunk = []
         for arg in argList:
-            self.results.append(self.pool.apply_async(func, args=[arg]))
+            chunk.append(arg)
+            if self.cancelled.is_set():
+                return chunk
+            if len(chunk) >= chunksize:
+                if not self.submit(func, chunk, background):
+                    return chunk
+                chunk = []
+                chunksize = min(2 * chunksize, self.chunksize)
+        if len(chunk) > 0 and not self.submit(func, chunk, background):
+            return chunk
+        return []
 
     def join(self):
         try:
-            return [r.get() for r in self.results]
+            while len(self.pending) > 0:
+                self.collect(block=True)
+            return self.total
 
         except KeyboardInterrupt:
             self.pool.terminate()
             self.pool.join()
+            self.pool = None
             raise
 
     def wait(self):
         try:
-            for r in self.results:
-                r.wait()
+            while len(self.pending) > 0:
+                self.collect(block=True)
             return 0
 
         except KeyboardInterrupt:
             self.pool.terminate()
             self.pool.join()
+            self.pool = None
             raise
 
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
     def __del__(self):
-        self.pool.close()
-        self.pool.join()
+        self.close()
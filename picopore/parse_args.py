@@ -18,14 +18,15 @@
 import os
 import sys
 
-from argparse import ArgumentParser, ArgumentError, Action, RawDescriptionHelpFormatter
+import warnings
+from argparse import ArgumentParser, ArgumentError, Action, RawDescriptionHelpFormatter, SUPPRESS
 from builtins import input
 
 from picopore.version import __version__
+from picopore.util import log, checkFilter, getH5repackArgs, getChunkPolicy, parseSize
 
 def checkDeprecatedArgs():
     import subprocess
-    import warnings
     import signal
     args = sys.argv[1:]
     if "--realtime" in args:
@@ -46,6 +47,12 @@ def checkDeprecatedArgs():
         p.wait()
     exit(p.returncode)
 
+def checkH5repack():
+    from subprocess import call, PIPE
+    if not call("type h5repack", shell=True, stdout=PIPE, stderr=PIPE) == 0:
+        log("h5repack (hdf5-tools) not installed. Aborting.")
+        exit(1)
+
 def checkInputs(args):
     args.input = [os.path.abspath(i) for i in args.input]
     # we go recursively - better remove duplicates
@@ -99,15 +106,36 @@ def addCommonArgs(parser):
     parser.add_argument('-v', '--version', action='version', version='Picopore {}'.format(__version__), help="show version number and exit")
     parser.add_argument("-y", action="store_true", default=False, help="skip confirm step")
     parser.add_argument("-t", "--threads", type=int, default=1, help="number of threads (Default: 1)", metavar="INT")
+    parser.add_argument("--chunk-size", type=int, default=16, help="maximum number of files sent to a thread at a time (Default: 16)", metavar="INT")
     parser.add_argument("--prefix", default=None, help="add prefix to output files to prevent overwrite", metavar="STR")
     parser.add_argument("--skip-root", action=AutoBool, default=False, help="ignore files in root input directories for albacore realtime compression")
-    parser.add_argument("--print-every", type=int, default=100, help="print a dot every approximately INT files, or -1 to silence (Default: 100)", metavar="INT")
+    parser.add_argument("--progress", choices=('text', 'json', 'none'), default="text", help="report completed files, bytes in and out, throughput and ETA as text or as one JSON object per line (Default: text)")
+    parser.add_argument("--progress-interval", type=float, default=10, help="report progress at most every FLOAT seconds (Default: 10)", metavar="FLOAT")
+    parser.add_argument("--print-every", type=int, default=None, help=SUPPRESS)
+    parser.add_argument("--profile", default=False, action="store_true", help="time each stage of processing and print a summary")
+    parser.add_argument("--profile-trace", default=None, help="write the stage timings of each file to FILE, as CSV if FILE ends in .csv or otherwise JSON lines (implies --profile)", metavar="FILE")
+    parser.add_argument("--profile-dir", default=None, help="write a cProfile dump for each worker to DIR (implies --profile)", metavar="DIR")
     parser.add_argument("input", nargs="*", help="list of directories or fast5 files to shrink")
     return parser
 
+def checkCommonArgs(parser, args):
+    if args.print_every is not None:
+        warnings.warn("--print-every will be removed in 2.0. Use --progress-interval or --progress none instead.", FutureWarning)
+        if args.print_every < 0:
+            args.progress = "none"
+    if args.profile_trace is not None or args.profile_dir is not None:
+        args.profile = True
+    if args.profile_dir is not None:
+        args.profile_dir = os.path.abspath(args.profile_dir)
+        if not os.path.isdir(args.profile_dir):
+            parser.error("--profile-dir {} is not a directory".format(args.profile_dir))
+    return args
+
 __description = """A tool for reducing the size of an Oxford Nanopore Technologies dataset without losing any data"""
-def parseArgs(description=None, prog='picopore'):
-    checkDeprecatedArgs()
+def parseArgs(description=None, prog='picopore', realtime=False, test=False, argv=None):
+    # argv is parsed in place of the command line, e.g. to build a runner's arguments in-process
+    if argv is None:
+        checkDeprecatedArgs()
     if description is not None:
         description = __description + "\n\n" + description
     else:
@@ -118,8 +146,56 @@ def parseArgs(description=None, prog='picopore'):
     parser.add_argument("--fastq", action=AutoBool, default=True, help="retain FASTQ data (raw mode only)")
     parser.add_argument("--summary", action=AutoBool, default=False, help="retain summary data (raw mode only)")
     parser.add_argument("--manual", default=None, help="manually remove only groups whose paths contain STR (raw mode only, regular expressions permitted, overrides defaults)", metavar="STR")
+    parser.add_argument("--h5repack", action=AutoBool, default=False, help="repack files using h5repack (hdf5-tools) rather than in-process")
+    parser.add_argument("--journal", default=None, help="append a record of each processed file to FILE", metavar="FILE")
+    parser.add_argument("--codec", default=None, help="filters used to compress datasets, comma separated from GZIP=[1-9], SHUF, LZF, ZSTD[=LEVEL] and BLOSC[=LEVEL] (ZSTD and BLOSC require hdf5plugin), or ADAPTIVE to choose per dataset by trial compression (Default: GZIP=9)", metavar="STR")
+    parser.add_argument("--chunk-policy", default=None, help="chunk shape of compressed datasets, comma separated [KEYWORD=]SIZE where SIZE is AUTO, WHOLE (one chunk) or a target in bytes (K and M suffixes permitted), applied to datasets whose paths contain KEYWORD, e.g. Signal=1M,Events=WHOLE,256K (Default: AUTO)", metavar="STR")
+    parser.add_argument("--min-free", default="0", help="hold files back while compressing them could leave less than SIZE bytes free on their filesystem (K, M and G suffixes permitted; Default: 0)", metavar="SIZE")
+    parser.add_argument("--largest-first", default=False, action="store_true", help="process the largest files first to free space sooner (lists every file before starting)")
+    parser.add_argument("--skip-compressed", action=AutoBool, default=True, help="skip files which are already in the state the chosen mode produces")
+    parser.add_argument("--resume", default=False, action="store_true", help="skip files already processed successfully in this mode according to --journal")
+    if realtime:
+        parser.add_argument("--watcher", choices=('watchdog', 'poll'), default="watchdog", help="detect new files with file system events (watchdog) or by listing the input directories periodically, for network filesystems where events are missed (Default: watchdog)")
+        parser.add_argument("--poll-interval", type=float, default=30, help="list the input directories every FLOAT seconds with --watcher poll (Default: 30)", metavar="FLOAT")
+        parser.add_argument("--quiet-period", type=float, default=5, help="wait until new files have not changed for FLOAT seconds and open as HDF5 before processing them (Default: 5)", metavar="FLOAT")
+        parser.add_argument("--batch-size", type=int, default=16, help="send up to INT complete new files to the workers at a time (Default: 16)", metavar="INT")
+        parser.add_argument("--summary-interval", type=float, default=300, help="log the size and throughput of compressed files every FLOAT seconds while monitoring (Default: 300)", metavar="FLOAT")
+        parser.add_argument("--backlog-share", type=float, default=0.5, help="fraction of threads compressing files present at startup while new files are waiting, from 0 (only when idle) to 1 (Default: 0.5)", metavar="FLOAT")
+        parser.add_argument("--max-queued", type=int, default=10000, help="maximum number of new files waiting to be complete before new files are held back (Default: 10000)", metavar="INT")
+    if test:
+        parser.add_argument("--float-ulps", type=int, default=0, help="tolerate floating point differences within INT units in the last place, reporting them separately (Default: 0, exact)", metavar="INT")
     parser = addCommonArgs(parser)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    args = checkCommonArgs(parser, args)
+    try:
+        args.min_free = parseSize(args.min_free)
+    except ValueError:
+        parser.error("--min-free {} not recognised".format(args.min_free))
+    if realtime and not 0 <= args.backlog_share <= 1:
+        parser.error("--backlog-share must be between 0 and 1")
+    if args.resume and args.journal is None:
+        parser.error("--resume requires --journal")
+    if args.journal is not None:
+        args.journal = os.path.abspath(args.journal)
+
+    if args.h5repack:
+        checkH5repack()
+    if args.codec is not None:
+        if args.revert:
+            parser.error("--codec cannot be used with --revert")
+        try:
+            getH5repackArgs(args.codec) if args.h5repack else checkFilter(args.codec)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.chunk_policy is not None:
+        if args.h5repack:
+            parser.error("--chunk-policy cannot be used with --h5repack")
+        try:
+            getChunkPolicy(args.chunk_policy)
+        except ValueError as e:
+            parser.error(str(e))
 
     args.input = checkInputs(args)
     args.group = "all" # TODO: is it worth supporting group?
@@ -132,5 +208,24 @@ def parseRenameArgs(description, prog='picopore-rename'):
     parser.add_argument('-r', '--replacement', required=True, help="String or regex replacement for PATTERN")
     parser = addCommonArgs(parser)
     args = parser.parse_args()
+    args = checkCommonArgs(parser, args)
+
+    return args
+
+def parseBenchArgs(description, prog='picopore-bench'):
+    parser = ArgumentParser(description=description, prog=prog)
+    parser.add_argument('-v', '--version', action='version', version='Picopore {}'.format(__version__), help="show version number and exit")
+    parser.add_argument("-n", "--files", type=int, default=100, help="number of synthetic files replicated from the samples (Default: 100)", metavar="INT")
+    parser.add_argument("-t", "--threads", type=int, nargs="+", default=[1], help="thread counts to benchmark (Default: 1)", metavar="INT")
+    parser.add_argument("--chunk-size", type=int, default=16, help="maximum number of files sent to a thread at a time (Default: 16)", metavar="INT")
+    parser.add_argument("--mode", choices=('lossless', 'deep-lossless', 'raw'), nargs="+", default=['lossless', 'deep-lossless', 'raw'], help="compression modes to benchmark; lossless modes are also reverted (Default: all)")
+    parser.add_argument("--directory", default=None, help="directory in which to replicate the samples, e.g. on the filesystem to be compressed (Default: a temporary directory)", metavar="DIR")
+    parser.add_argument("--output", default=None, help="write the JSON report to FILE (Default: standard output)", metavar="FILE")
+    parser.add_argument("input", nargs="*", help="sample fast5 files or directories to replicate (Default: sample_data/*_original.fast5)")
+    args = parser.parse_args()
 
+    if args.files < 1:
+        parser.error("--files must be at least 1")
+    if min(args.threads) < 1:
+        parser.error("--threads must be at least 1")
     return args
@@ -0,0 +1,91 @@
+"""
+    This file is part of Picopore.
+
+    Picopore is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Picopore is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Picopore.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import threading
+import numpy as np
+
+from picopore.util import scanFast5, log
+
+class DirectoryPoller(object):
+    # watches directories by listing them periodically, for filesystems such as NFS or Lustre
+    # where file system events are missed; stands in for watchdog's Observer
+    # files are remembered by a 64-bit hash of their path in a sorted array, 8 bytes per file
+
+    def __init__(self, paths, callback, interval=30, skip_root=False, batchSize=4096):
+        self.paths = paths
+        self.callback = callback
+        self.interval = interval
+        self.skip_root = skip_root
+        self.batchSize = batchSize
+        self.seen = np.empty(0, dtype='int64')
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def isNew(self, keys):
+        if self.seen.shape[0] == 0:
+            return np.ones(keys.shape, dtype=bool)
+        index = np.minimum(np.searchsorted(self.seen, keys), self.seen.shape[0] - 1)
+        return self.seen[index] != keys
+
+    def diff(self, batch, announce):
+        keys = np.array([hash(path) for path in batch], dtype='int64')
+        if announce:
+            for i in np.flatnonzero(self.isNew(keys)):
+                self.callback(batch[i])
+        return keys
+
+    def scan(self, announce=True):
+        # compare the current listing with the last, a batch of paths at a time
+        current = []
+        batch = []
+        try:
+            for path in self.paths:
+                for filename in scanFast5(path, self.skip_root):
+                    batch.append(filename)
+                    if len(batch) >= self.batchSize:
+                        current.append(self.diff(batch, announce))
+                        batch = []
+            if len(batch) > 0:
+                current.append(self.diff(batch, announce))
+        except OSError as e:
+            # e.g. a directory removed during the listing: keep the last listing and try again later
+            log("ERROR: {} while listing {}".format(str(e), ", ".join(self.paths)))
+            return
+        # files deleted since the last listing are forgotten
+        self.seen = np.unique(np.concatenate(current)) if len(current) > 0 else np.empty(0, dtype='int64')
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.scan()
+
+    def start(self):
+        # files present at startup are left to the runner's own search
+        self.scan(announce=False)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
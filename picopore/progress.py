@@ -0,0 +1,104 @@
+"""
+    This file is part of Picopore.
+
+    Picopore is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Picopore is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Picopore.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import time
+import json
+
+from picopore.util import log
+
+class ProgressReporter(object):
+    # progress of a run, updated in the parent as workers finish chunks of files
+    # reports at most once per interval, as text or as one JSON object per line
+
+    def __init__(self, fmt="text", interval=10):
+        self.fmt = fmt
+        self.interval = interval
+        self.startTime = time.time()
+        self.files = 0
+        self.errors = 0
+        self.skipped = 0
+        self.bytesIn = 0
+        self.bytesOut = None
+        # files to process, set by the runner once discovery has finished
+        self.total = None
+        # position at the last report, for the current rate
+        self.lastTime = self.startTime
+        self.lastFiles = 0
+        self.lastBytesIn = 0
+
+    def update(self, files, errors, bytesIn, bytesOut=None, skipped=0):
+        self.files += files
+        self.errors += errors
+        self.bytesIn += bytesIn
+        if bytesOut is not None:
+            self.bytesOut = bytesOut + (self.bytesOut or 0)
+        self.skipped = skipped
+        if time.time() - self.lastTime >= self.interval:
+            self.report()
+
+    def getETA(self, elapsed):
+        if self.total is None or self.files == 0:
+            return None
+        return max(self.total - self.files, 0) * elapsed / self.files
+
+    def report(self, event="progress"):
+        now = time.time()
+        window = max(now - self.lastTime, 1e-6)
+        elapsed = max(now - self.startTime, 1e-6)
+        filesPerSecond = (self.files - self.lastFiles) / window
+        mbPerSecond = (self.bytesIn - self.lastBytesIn) / window / 2.0**20
+        if event != "progress":
+            # final report: average over the whole run
+            filesPerSecond = self.files / elapsed
+            mbPerSecond = self.bytesIn / elapsed / 2.0**20
+        eta = self.getETA(elapsed)
+        if self.fmt == "json":
+            log(json.dumps({
+                "event" : event,
+                "files" : self.files,
+                "total" : self.total,
+                "skipped" : self.skipped,
+                "errors" : self.errors,
+                "bytes_in" : self.bytesIn,
+                "bytes_out" : self.bytesOut,
+                "files_per_second" : round(filesPerSecond, 3),
+                "mb_per_second" : round(mbPerSecond, 3),
+                "elapsed_seconds" : round(elapsed, 3),
+                "eta_seconds" : round(eta, 1) if eta is not None and event == "progress" else None,
+            }, sort_keys=True))
+        elif self.fmt == "text":
+            message = "{} {} files".format("Progress:" if event == "progress" else "Processed", self.files)
+            if self.total is not None:
+                message += " of {}".format(self.total)
+            message += ", {:.1f} MB in".format(self.bytesIn / 2.0**20)
+            if self.bytesOut is not None:
+                message += ", {:.1f} MB out".format(self.bytesOut / 2.0**20)
+            message += ", {:.1f} files/s, {:.1f} MB/s".format(filesPerSecond, mbPerSecond)
+            if event == "progress" and eta is not None:
+                message += ", ETA {}".format(formatSeconds(eta))
+            elif event != "progress":
+                message += " in {}".format(formatSeconds(elapsed))
+            log(message)
+        self.lastTime = now
+        self.lastFiles = self.files
+        self.lastBytesIn = self.bytesIn
+
+def formatSeconds(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
@@ -16,6 +16,8 @@
 """
 
 import os
+import time
+import threading
 from time import sleep
 from watchdog.observers import Observer
 from watchdog.events import PatternMatchingEventHandler
@@ -25,6 +27,8 @@ from picopore.runner import PicoporeCompressionRunner
 from picopore.compress import chooseCompressFunc
 from picopore.parse_args import parseArgs, checkSure
 from picopore.util import log
+from picopore.ingest import IngestQueue
+from picopore.poll import DirectoryPoller
 
 class ReadsFolder(object):
     def __init__(self, runner):
@@ -36,29 +40,42 @@ class ReadsFolder(object):
         self.event_handler.on_created = self.on_created
         self.event_handler.on_moved = self.on_moved
 
-        self.observer = Observer()
+        self.queue = IngestQueue(runner, runner.quietPeriod, runner.batchSize, runner.maxQueued)
+        self.backlog = None
 
-        self.observedPaths = []
-        for path in self.runner.input:
-            if os.path.isdir(path):
+        self.observedPaths = [path for path in self.runner.input if os.path.isdir(path)]
+        if runner.watcher == "poll":
+            self.observer = DirectoryPoller(self.observedPaths, self.on_found, runner.pollInterval, runner.skip_root)
+        else:
+            self.observer = Observer()
+            for path in self.observedPaths:
                 self.observer.schedule(self.event_handler, path, recursive=True)
-                self.observedPaths.append(path)
         log("Monitoring {} in real time. Press Ctrl+C to exit.".format(", ".join(self.observedPaths)))
 
     def start(self):
+        self.queue.start()
         self.observer.start()
-        self.runner.run(postprocess=False)
+        # files already present yield workers to new files, which are compressed as they arrive
+        # the backlog is submitted from its own thread, so that monitoring starts straight away
+        self.backlog = threading.Thread(target=self.runner.run, kwargs={"postprocess": False, "background": True})
+        self.backlog.daemon = True
+        self.backlog.start()
 
     def add_file(self, path):
-        self.runner.process([path])
+        # wait until the file is complete before processing it
+        self.queue.add(path)
 
     def on_created(self, event):
         if self.runner.skip_root and os.path.dirname(event.src_path) in self.observedPaths:
             return 0
-        elif self.runner.prefix is not None and os.path.basename(event.src_path).startswith(self.runner.prefix):
+        else:
+            return self.on_found(event.src_path)
+
+    def on_found(self, path):
+        if self.runner.prefix is not None and os.path.basename(path).startswith(self.runner.prefix):
             return 0
         else:
-            self.add_file(event.src_path)
+            self.add_file(path)
             return 0
 
     def on_moved(self, event):
@@ -67,20 +84,35 @@ class ReadsFolder(object):
 
     def stop(self):
         log("Processing in-progress files. Press Ctrl-C again to abort.")
+        self.observer.stop()
+        if self.observer.is_alive():
+            self.observer.join()
+        # files not yet submitted, from the backlog or the ingest queue, are left for the next run
+        self.runner.multiprocessor.cancel()
         try:
+            self.queue.stop()
+            if self.backlog is not None:
+                self.backlog.join()
             self.runner.stop()
         except KeyboardInterrupt:
             log("Aborted.")
             pass
-
-        self.observer.stop()
-        self.observer.join()
+        self.runner.multiprocessor.close()
 
 class PicoporeRealtimeRunner(PicoporeCompressionRunner):
 
     def __init__(self, args):
         super(PicoporeRealtimeRunner, self).__init__(args)
-        _, name = chooseCompressFunc(self.revert, self.mode, self.fastq, self.summary, self.manual, realtime=True)
+        self.quietPeriod = args.quiet_period
+        self.batchSize = args.batch_size
+        self.maxQueued = args.max_queued
+        self.watcher = args.watcher
+        self.pollInterval = args.poll_interval
+        self.summaryInterval = args.summary_interval
+        self.multiprocessor.setBacklogShare(args.backlog_share)
+        # running totals at the last summary
+        self.lastSummary = (time.time(), 0, 0)
+        _, name = chooseCompressFunc(self.revert, self.mode, self.fastq, self.summary, self.manual, realtime=True, codec=self.codec)
         log(name + "...",end='')
         if self.y:
             log()
@@ -90,11 +122,32 @@ class PicoporeRealtimeRunner(PicoporeCompressionRunner):
             exit(1)
         self.readsFolder = ReadsFolder(self)
 
+    def dispatch(self, fileList):
+        # files picopore has already compressed, e.g. after repeated events, are skipped by the workers
+        if self.largestFirst:
+            fileList = self.sortLargestFirst(fileList)
+        self.process(fileList)
+
+    def summarise(self):
+        # size and throughput since the last summary, from the running totals
+        now = time.time()
+        lastTime, lastCompleted, lastBytesIn = self.lastSummary
+        elapsed = max(now - lastTime, 1e-6)
+        log("Summary: {} files, {:.1f} MB {} to {:.1f} MB; {:.1f} files/s, {:.1f} MB/s in the last {:.0f}s; {} files waiting to be complete".format(
+            self.completed, self.bytesIn / 2.0**20, "reverted" if self.revert else "compressed", self.bytesOut / 2.0**20,
+            (self.completed - lastCompleted) / elapsed, (self.bytesIn - lastBytesIn) / elapsed / 2.0**20, elapsed,
+            len(self.readsFolder.queue.pending)))
+        self.lastSummary = (now, self.completed, self.bytesIn)
+
     def execute(self):
-        self.readsFolder.start()
         try:
+            self.readsFolder.start()
             while True:
-                sleep(5)
+                sleep(min(5, self.summaryInterval))
+                # fold finished work into the totals even when no new files arrive
+                self.multiprocessor.collect()
+                if time.time() - self.lastSummary[0] >= self.summaryInterval:
+                    self.summarise()
         except KeyboardInterrupt:
             log("\nExiting Picopore.")
         self.readsFolder.stop()
@@ -103,7 +156,7 @@ class PicoporeRealtimeRunner(PicoporeCompressionRunner):
 __description = """"picopore-realtime monitors a directory for new reads and compresses them in real time"""
 
 def main():
-    args = parseArgs(description=__description, prog='picopore-realtime')
+    args = parseArgs(description=__description, prog='picopore-realtime', realtime=True)
     runner = PicoporeRealtimeRunner(args)
     return runner.execute()
 
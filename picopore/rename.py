@@ -49,11 +49,11 @@ class PicoporeRenameRunner(AbstractPicoporeRunner):
         message = "Renaming {} to {}".format(self.pattern, self.replacement)
         return func, message
 
-    def preprocess(self, fileList):
-        self.processed += len(fileList)
+    def preprocess(self, filename):
+        self.processed += 1
 
-    def postprocess(self, results):
-        log("Successfully renamed {} of {} files.".format(self.processed - sum(results), self.processed))
+    def postprocess(self, total):
+        log("Successfully renamed {} of {} files.".format(self.processed - total, self.processed))
         return self.processed
 
 __description = """"A tool for renaming groups and datasets within Oxford Nanopore Technologies FAST5 files"""
@@ -18,76 +18,191 @@ import os
 import sys
 import functools
 from shutil import copyfile
-import numpy as np
+from multiprocessing.managers import SyncManager
 
 from picopore.parse_args import checkSure
-from picopore.util import recursiveFindFast5, log, getPrefixedFilename
-from picopore.compress import chooseCompressFunc
-from picopore.multiprocess import Multiprocessor
-
-def _process_func(filename, func, prefix, print_every):
-        if prefix is not None:
-            newFilename = getPrefixedFilename(filename, prefix)
-            copyfile(filename, newFilename)
-        else:
-            newFilename = filename
-        result = func(newFilename)
-        if result is not None and print_every > 0 and np.random.rand() < 1.0/print_every:
-            log('.', end='')
+from picopore.util import findFast5, log, getPrefixedFilename, SkippedFile, isAdaptive
+from picopore.compress import chooseCompressFunc, chooseCheckFunc, checkCompressed
+from picopore.multiprocess import Multiprocessor, init_worker
+from picopore.journal import Journal
+from picopore import timing
+from picopore.progress import ProgressReporter
+from picopore.diskspace import DiskSpaceThrottle
+
+def _process_func(filename, func, prefix, profile=False, profileDir=None, skip=None):
+        if profile:
+            timing.startFile(filename, profileDir)
+        try:
+            if skip is not None:
+                # checked here rather than during discovery, so that files are opened in parallel
+                with timing.stage("check"):
+                    if skip(filename):
+                        raise SkippedFile(filename)
+            if prefix is not None:
+                newFilename = getPrefixedFilename(filename, prefix)
+                with timing.stage("copy"):
+                    copyfile(filename, newFilename)
+            else:
+                newFilename = filename
+            result = func(newFilename)
+        finally:
+            if profile:
+                timing.finishFile()
         return result
 
 class AbstractPicoporeRunner(object):
 
     def __init__(self, args):
         self.y = args.y
-        self.multiprocessor = Multiprocessor(args.threads)
+        self.profile = args.profile
+        self.profileDir = args.profile_dir
+        self.timingReport = timing.TimingReport(args.profile_trace) if self.profile else None
+        self.multiprocessor = Multiprocessor(args.threads, args.chunk_size, callback=self.fold)
         self.prefix = args.prefix
         self.skip_root = args.skip_root
-        self.print_every = args.print_every
+        self.progress = ProgressReporter(args.progress, args.progress_interval) if args.progress != "none" else None
+        # sizes of submitted files, until they are finished
+        self.sizes = {}
         self.input = args.input
+        self.fileCount = 0
+        # file lists still being discovered
+        self.discovering = 0
+        # running totals of finished files
+        self.completed = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+    def reset(self):
+        # start the counts and totals again, for a second run by the same runner
+        with self.multiprocessor.foldLock:
+            self.fileCount = 0
+            self.sizes = {}
+            self.completed = 0
+            self.bytesIn = 0
+            self.bytesOut = 0
+            if self.progress is not None:
+                self.progress = ProgressReporter(self.progress.fmt, self.progress.interval)
+        self.multiprocessor.reset()
 
     def get_func(self):
         raise NotImplementedError()
         return func, message
 
-    def preprocess(self, fileList):
+    def preprocess(self, filename):
         raise NotImplementedError()
 
-    def postprocess(self, results):
+    def postprocess(self, total):
         raise NotImplementedError()
         return 0 # exitcode
 
     def getFileList(self):
-        return recursiveFindFast5(self.input, self.skip_root)
+        return findFast5(self.input, self.skip_root)
+
+    def count(self, fileList):
+        # a running count, so the total for the ETA needs no separate pass over the directories
+        # in real time, the backlog and new files are counted from two threads while a third folds results,
+        # so counters are only updated under the multiprocessor's fold lock
+        lock = self.multiprocessor.foldLock
+        with lock:
+            self.discovering += 1
+        try:
+            for filename in fileList:
+                try:
+                    size = os.path.getsize(filename)
+                except OSError:
+                    # let the worker report the missing file
+                    size = None
+                with lock:
+                    self.fileCount += 1
+                    if size is not None:
+                        self.sizes[filename] = size
+                    self.preprocess(filename)
+                yield filename
+        finally:
+            with lock:
+                self.discovering -= 1
+        with lock:
+            if self.discovering == 0 and self.progress is not None:
+                self.progress.total = self.fileCount
+
+    def uncount(self, fileList):
+        # files counted but never submitted
+        with self.multiprocessor.foldLock:
+            for filename in fileList:
+                self.fileCount -= 1
+                self.sizes.pop(filename, None)
+
+    def getSkipCheck(self):
+        # a function run by the workers, reporting whether a file can be skipped
+        return None
+
+    def skip(self, fileList):
+        # files skipped by the workers
+        self.uncount(fileList)
+
+    def getSkipped(self):
+        # files found but not processed
+        return 0
+
+    def getOutputSize(self, total):
+        # bytes written, if the workers' results are file sizes
+        return None
+
+    def fold(self, chunk, total, processed, errors, skipped, records):
+        # called once per finished chunk, so nothing is kept per file once it is done
+        if len(skipped) > 0:
+            self.skip(skipped)
+            processed -= len(skipped)
+            if self.discovering == 0 and self.progress is not None:
+                self.progress.total = self.fileCount
+        bytesIn = sum([self.sizes.pop(filename, 0) for filename in chunk])
+        bytesOut = self.getOutputSize(total)
+        self.completed += processed
+        self.bytesIn += bytesIn
+        self.bytesOut += bytesOut if bytesOut is not None else 0
+        if self.timingReport is not None:
+            self.timingReport.add(records)
+        if self.progress is not None:
+            self.progress.update(processed, errors, bytesIn, bytesOut, self.getSkipped())
 
-    def process(self, fileList):
-        self.preprocess(fileList)
-        self.multiprocessor.apply_async(self.func, fileList)
+    def process(self, fileList, background=False):
+        if self.timingReport is not None:
+            fileList = self.timingReport.time("discovery", fileList)
+        self.uncount(self.multiprocessor.apply_async(self.func, self.count(fileList), background))
 
     def stop(self):
-        results = self.multiprocessor.join()
-        log("Complete.")
-        return self.postprocess(results)
+        total = self.multiprocessor.join()
+        if self.progress is not None:
+            # files may all have been skipped, with no chunk to update the count
+            self.progress.skipped = self.getSkipped()
+            self.progress.report("complete")
+        log("Complete on {} files.".format(self.fileCount))
+        if self.multiprocessor.errors > 0:
+            log("Failed on {} of {} files.".format(self.multiprocessor.errors, self.multiprocessor.processed))
+        if self.timingReport is not None:
+            self.timingReport.summary()
+            self.timingReport.close()
+        return self.postprocess(total)
 
-    def run(self, postprocess=True):
+    def run(self, postprocess=True, background=False):
         func, message = self.get_func()
-        self.func = functools.partial(_process_func, func=func, prefix=self.prefix, print_every=self.print_every)
-        fileList = self.getFileList()
-        if len(fileList) == 0:
-            return 0
-        log("{} on {} files... ".format(message, len(fileList)))
+        self.func = functools.partial(_process_func, func=func, prefix=self.prefix, profile=self.profile, profileDir=self.profileDir,
+                                      skip=self.getSkipCheck())
+        log("{} on {}... ".format(message, ", ".join(self.input)))
         if self.y or checkSure():
-            self.process(fileList)
+            self.process(self.getFileList(), background)
             if postprocess:
                 return self.stop()
             else:
-                return self.multiprocessor.wait()
+                # the caller collects results as they finish
+                return 0
         else:
             log("User cancelled. Exiting.")
             exit(1)
 
     def execute(self):
         self.run()
+        self.multiprocessor.close()
         return 0
 
 class PicoporeCompressionRunner(AbstractPicoporeRunner):
@@ -100,19 +215,103 @@ class PicoporeCompressionRunner(AbstractPicoporeRunner):
         self.summary = args.summary
         self.manual = args.manual
         self.group = args.group
+        self.h5repack = args.h5repack
+        self.codec = args.codec
+        self.chunkPolicy = args.chunk_policy
+        self.journalFile = args.journal
+        self.resume = args.resume
+        self.skipped = 0
+        self.skip_compressed = args.skip_compressed
+        self.alreadyCompressed = 0
         self.preSize = 0
         self.postSize = 0
+        self.largestFirst = args.largest_first
+        self.adaptiveShared = None
+        if self.codec is not None and isAdaptive(self.codec):
+            # --codec ADAPTIVE chooses one filter per class of dataset for the whole run, whichever worker meets it first
+            self.manager = SyncManager()
+            self.manager.start(init_worker)
+            self.adaptiveShared = (self.manager.dict(), self.manager.Lock())
+        # each file is written to a .tmp copy (and, with --prefix, copied first) before replacing its input;
+        # reverted files grow, so their output is only partly offset by the inputs they replace
+        self.multiprocessor.throttle = DiskSpaceThrottle(args.min_free, expansion=(2 if self.revert else 1) + (1 if self.prefix is not None else 0),
+                                                         cumulative=self.revert or self.prefix is not None)
 
     def get_func(self):
-        func, message = chooseCompressFunc(self.revert, self.mode, self.fastq, self.summary, self.manual)
-        func = functools.partial(func, group=self.group)
+        func, message = chooseCompressFunc(self.revert, self.mode, self.fastq, self.summary, self.manual, codec=self.codec)
+        journal = None
+        if self.journalFile is not None:
+            journal = Journal(self.journalFile, message.replace("Performing ", "", 1))
+            if self.resume:
+                self.journal = journal
+                self.journal.load()
+        func = functools.partial(func, group=self.group, h5repack=self.h5repack, journal=journal, chunkPolicy=self.chunkPolicy,
+                                 adaptiveShared=self.adaptiveShared)
+        self.check = chooseCheckFunc(self.revert, self.mode, self.fastq, self.summary, self.manual, codec=self.codec)
         return func, message
 
-    def preprocess(self, fileList):
-        self.preSize += sum([os.path.getsize(f) for f in fileList])
+    def getFileList(self):
+        fileList = super(PicoporeCompressionRunner, self).getFileList()
+        if self.resume:
+            fileList = self.skipCompleted(fileList)
+        if self.largestFirst:
+            fileList = self.sortLargestFirst(fileList)
+        return fileList
+
+    def sortLargestFirst(self, fileList):
+        # frees the most space soonest, at the cost of listing every file before starting
+        def getSize(filename):
+            try:
+                return os.path.getsize(filename)
+            except OSError:
+                return 0
+        return sorted(fileList, key=getSize, reverse=True)
+
+    def skipCompleted(self, fileList):
+        for filename in fileList:
+            if self.journal.isComplete(getPrefixedFilename(filename, self.prefix)):
+                self.skipped += 1
+            else:
+                yield filename
+
+    def getSkipCheck(self):
+        if self.skip_compressed and self.check is not None:
+            return functools.partial(checkCompressed, self.check, group=self.group)
+        return None
+
+    def skip(self, fileList):
+        self.alreadyCompressed += len(fileList)
+        super(PicoporeCompressionRunner, self).skip(fileList)
+
+    def preprocess(self, filename):
+        self.preSize += self.sizes.get(filename, 0)
+
+    def reset(self):
+        with self.multiprocessor.foldLock:
+            self.skipped = 0
+            self.alreadyCompressed = 0
+            self.preSize = 0
+            self.postSize = 0
+            super(PicoporeCompressionRunner, self).reset()
+
+    def uncount(self, fileList):
+        with self.multiprocessor.foldLock:
+            for filename in fileList:
+                self.preSize -= self.sizes.get(filename, 0)
+            super(PicoporeCompressionRunner, self).uncount(fileList)
+
+    def getSkipped(self):
+        return self.skipped + self.alreadyCompressed
+
+    def getOutputSize(self, total):
+        return total
 
-    def postprocess(self, results):
-        self.postSize = sum(results)
+    def postprocess(self, total):
+        self.postSize = total
+        if self.skipped > 0:
+            log("Skipped {} files already complete in {}".format(self.skipped, self.journalFile))
+        if self.alreadyCompressed > 0:
+            log("Skipped {} files already {}".format(self.alreadyCompressed, "reverted" if self.revert else "compressed"))
         if self.revert:
             preStr, postStr = "Compressed size:", "Reverted size:"
         else:
@@ -17,81 +17,122 @@
 
 import h5py
 import os
+import functools
+import numpy as np
 
-from picopore.util import log, isGroup, isArray, getPrefixedFilename
+from picopore.util import log, isGroup, getPrefixedFilename
 from picopore.runner import PicoporeCompressionRunner
 from picopore.parse_args import parseArgs
 
 def checkContents(obj1, obj2, name=None):
+    # attribute managers have no name of their own, so callers pass the path
     name = obj1.name if name is None else name
     keys1 = obj1.keys()
     keys2 = obj2.keys()
     exitcode = 0
     for key in keys1:
         if key not in keys2:
-            log("Failure: {} missing from file 2".format("/".join([obj2.name, key])))
+            log("Failure: {} missing from file 2".format("/".join([name.rstrip("/"), key])))
             exitcode += 1
     for key in keys2:
         if key not in keys1:
-            log("Failure: {} missing from file 1".format("/".join([obj1.name, key])))
+            log("Failure: {} missing from file 1".format("/".join([name.rstrip("/"), key])))
             exitcode += 1
     return exitcode
 
-def checkData(data1, data2, name):
-    match = data1==data2
-    exitcode = 0
-    if isArray(match):
-        match = (data1==data2).all()
-    if not match:
-        positions = [i for i in range(len(data1)) if not data1[i] == data2]
-        for pos in positions:
-            log("Failure: {}[{}] - file1={}, file2={}".format(name, pos, data1[pos], data2[pos]))
-            exitcode += 1
-    return exitcode
-
-def recursiveCheckEquivalent(file1, file2, name):
+def getSharedKeys(obj1, obj2):
+    # keys missing from either object are reported by checkContents and not compared
+    return [key for key in obj1.keys() if key in obj2]
+
+__max_reported__ = 10
+
+def isEqual(data1, data2, ulps=0):
+    # elementwise equality, treating NaN as equal to NaN
+    # with ulps > 0, floats within ulps units in the last place are also equal
+    if data1.dtype.kind + data2.dtype.kind in ["SU", "US"]:
+        # h5py reads fixed length strings as bytes and variable length strings as str
+        data1 = np.char.decode(data1, 'utf-8') if data1.dtype.kind == 'S' else data1
+        data2 = np.char.decode(data2, 'utf-8') if data2.dtype.kind == 'S' else data2
+    match = np.asarray(data1 == data2)
+    if match.shape != data1.shape:
+        # incomparable types
+        return np.zeros(data1.shape, dtype=bool)
+    if data1.dtype.kind in 'fc' and data2.dtype.kind in 'fc':
+        match |= np.isnan(data1) & np.isnan(data2)
+        if ulps > 0:
+            eps = max(np.finfo(data1.dtype).eps, np.finfo(data2.dtype).eps)
+            match |= np.abs(data1 - data2) <= ulps * eps * np.maximum(np.abs(data1), np.abs(data2))
+    return match
+
+def checkData(data1, data2, name, maxReported=__max_reported__, ulps=0):
+    data1 = np.asarray(data1)
+    data2 = np.asarray(data2)
+    if not data1.shape == data2.shape:
+        log("Failure: {}.shape - file1={}, file2={}".format(name, data1.shape, data2.shape))
+        return 1
+    exact = isEqual(data1, data2)
+    if ulps > 0:
+        # tolerated differences are reported, but not counted as failures
+        match = isEqual(data1, data2, ulps)
+        tolerated = np.count_nonzero(match & ~exact)
+        if tolerated > 0:
+            log("Tolerated: {} - {} differences within {} ulps".format(name, tolerated, ulps))
+        exact = match
+    positions = np.flatnonzero(~exact)
+    for pos in positions[:maxReported]:
+        index = ",".join([str(i) for i in np.unravel_index(pos, data1.shape)]) if data1.ndim > 1 else pos
+        log("Failure: {}[{}] - file1={}, file2={}".format(name, index, data1.flat[pos], data2.flat[pos]))
+    if len(positions) > maxReported:
+        log("Failure: {} - {} more differences not shown".format(name, len(positions) - maxReported))
+    return len(positions)
+
+def recursiveCheckEquivalent(file1, file2, name, ulps=0):
     obj1 = file1[name]
-    obj2 = file1[name]
+    obj2 = file2[name]
     # check attributes
     attr1 = obj1.attrs
     attr2 = obj2.attrs
     attrsName = "/".join([name, "attrs"])
     exitcode = checkContents(attr1, attr2, attrsName)
     for key, value in attr1.items():
-        try:
-            if not attr2[key] == value:
-                log("Failure: {} - file1={}, file2={}".format("/".join([attrsName, key]), value, attr2[key]))
-                exitcode += 1
-        except ValueError as e:
-            # probably a numpy array
-            if str(e) == "The truth value of an array with more than one element is ambiguous. Use a.any() or a.all()" and not (attr2[key] == value).all():
-                log("Failure: {} - file1={}, file2={}".format("/".join([attrsName, key]), value, attr2[key]))
-                exitcode += 1
+        if key in attr2:
+            exitcode += checkData(value, attr2[key], "/".join([attrsName, key]), ulps=ulps)
     # check subgroups / datasets
-    if isGroup(obj1):
-        exitcode += checkContents(obj1, obj2)
-        for key in obj1.keys():
-            exitcode += recursiveCheckEquivalent(file1, file2, "/".join([name, key]))
+    if isGroup(obj1) != isGroup(obj2):
+        log("Failure: {} is a {} in file 1 and a {} in file 2".format(name, *["group" if isGroup(obj) else "dataset" for obj in [obj1, obj2]]))
+        exitcode += 1
+    elif isGroup(obj1):
+        exitcode += checkContents(obj1, obj2, name)
+        for key in getSharedKeys(obj1, obj2):
+            exitcode += recursiveCheckEquivalent(file1, file2, "/".join([name, key]), ulps)
     else:
         if not obj1.shape == obj2.shape:
             log("Failure: {}.shape - file1={}, file2={}".format(name, obj1.shape, obj2.shape))
-        if obj1.dtype.names is None:
+            exitcode += 1
+        elif obj1.dtype.names is None:
             # just one column
-            exitcode += checkData(obj1, obj2, name)
+            exitcode += checkData(obj1[()], obj2[()], name, ulps=ulps)
         else:
+            data1, data2 = obj1[()], obj2[()]
             for col in obj1.dtype.names:
-                exitcode += checkData(obj1[col], obj2[col], ".".join([name, col]))
+                if obj2.dtype.names is None or col not in obj2.dtype.names:
+                    log("Failure: {} missing from file 2".format(".".join([name, col])))
+                    exitcode += 1
+                else:
+                    exitcode += checkData(data1[col], data2[col], ".".join([name, col]), ulps=ulps)
     return exitcode
 
-def checkEquivalent(fn1, fn2):
+def checkEquivalent(fn1, fn2, ulps=0):
     log("Checking equivalence of {} (file 1) and {} (file 2)...".format(fn1, fn2))
     with h5py.File(fn1, 'r') as file1, h5py.File(fn2, 'r') as file2:
         exitcode = checkContents(file1, file2)
-        for group in file1.values():
-            exitcode += recursiveCheckEquivalent(file1, file2, group.name)
+        for key in getSharedKeys(file1, file2):
+            exitcode += recursiveCheckEquivalent(file1, file2, "/" + key, ulps)
     log("Complete with {} errors.".format(exitcode))
     return exitcode
-    
+
+def checkEquivalentPair(filenames, ulps=0):
+    return checkEquivalent(*filenames, ulps=ulps)
 
 
 class PicoporeTestRunner(PicoporeCompressionRunner):
@@ -99,12 +140,16 @@ class PicoporeTestRunner(PicoporeCompressionRunner):
     def __init__(self, args):
         super(PicoporeTestRunner, self).__init__(args)
         if "lossless" not in self.mode:
-            raise ArgumentError(test, "{} mode not reversible by Picopore. Test cancelled.".format(self.mode))
+            log("{} mode not reversible by Picopore. Test cancelled.".format(self.mode))
+            exit(1)
         if self.prefix is None:
             self.prefix = "picopore.test"
-        self.fileList = super(PicoporeTestRunner, self).getFileList()
+        # every file must be compressed and reverted to be compared
+        self.skip_compressed = False
+        self.fileList = list(super(PicoporeTestRunner, self).getFileList())
         self.y = True
         self.originalFileList = self.fileList
+        self.floatUlps = args.float_ulps
 
     def getFileList(self):
         return self.fileList
@@ -112,6 +157,14 @@ class PicoporeTestRunner(PicoporeCompressionRunner):
     def getReversionFileList(self):
         return [getPrefixedFilename(f, self.prefix) for f in self.fileList]
 
+    def checkAll(self):
+        # compare each pair of files on the worker pool; comparing writes nothing, so needs no disk space
+        self.multiprocessor.throttle = None
+        total, errors = self.multiprocessor.total, self.multiprocessor.errors
+        self.multiprocessor.apply_async(functools.partial(checkEquivalentPair, ulps=self.floatUlps), zip(self.originalFileList, self.fileList))
+        self.multiprocessor.join()
+        return (self.multiprocessor.total - total) + (self.multiprocessor.errors - errors)
+
     def execute(self):
         exitcode=1
         if len(self.fileList) == 0:
@@ -119,19 +172,20 @@ class PicoporeTestRunner(PicoporeCompressionRunner):
         try:
             self.revert = False
             self.run()
+            # files which failed to compress or revert fail the test, as well as differences
+            errors = self.multiprocessor.errors
 
-            self.preSize = 0
-            self.postSize = 0
+            self.reset()
             self.revert = True
             self.fileList = self.getReversionFileList()
             self.prefix = None
             self.run()
-            exitcode = 0
-            for i in range(len(self.fileList)):
-                exitcode += checkEquivalent(self.originalFileList[i], self.fileList[i])
+            errors += self.multiprocessor.errors
+            exitcode = errors + self.checkAll()
         except Exception as e:
             log("ERROR: " + str(e))
         finally:
+            self.multiprocessor.close()
             for f in self.fileList:
                 try:
                     os.remove(f)
@@ -143,7 +197,7 @@ class PicoporeTestRunner(PicoporeCompressionRunner):
 __description = """"picopore-test compresses to temporary files and checks that all datasets and attributes are equal (lossless modes only)"""
         
 def main():
-    args = parseArgs(description=__description, prog='picopore-test')
+    args = parseArgs(description=__description, prog='picopore-test', test=True)
     runner = PicoporeTestRunner(args)
     return runner.execute()
 
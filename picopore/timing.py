@@ -0,0 +1,145 @@
+"""
+    This file is part of Picopore.
+
+    Picopore is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Picopore is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Picopore.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import time
+import json
+import cProfile
+from contextlib import contextmanager
+
+from picopore.util import log
+
+# stages timed per file, in the order they happen; discovery is timed in the parent across all files
+__stages__ = ["discovery", "check", "copy", "read", "rewrite", "write", "h5repack", "mv", "journal", "total"]
+__file_stages__ = __stages__[1:]
+
+# per-process state: the record of the file being processed and the finished records not yet returned
+__current__ = None
+__records__ = []
+__cprofile__ = None
+__profile_dir__ = None
+
+def startFile(filename, profileDir=None):
+    global __current__, __cprofile__, __profile_dir__
+    __current__ = {"file" : filename, "pid" : os.getpid(), "start" : time.time()}
+    if profileDir is not None:
+        if __cprofile__ is None:
+            __cprofile__ = cProfile.Profile()
+            __profile_dir__ = profileDir
+        __cprofile__.enable()
+
+def finishFile():
+    global __current__
+    if __current__ is None:
+        return
+    record = __current__
+    __current__ = None
+    record["total"] = time.time() - record.pop("start")
+    __records__.append(record)
+    if __cprofile__ is not None:
+        __cprofile__.disable()
+
+def dumpProfile():
+    # cumulative over every file this worker has processed, written once per chunk rather than per file
+    if __cprofile__ is not None:
+        __cprofile__.dump_stats(os.path.join(__profile_dir__, "picopore.{}.prof".format(os.getpid())))
+
+@contextmanager
+def stage(name):
+    # times the enclosed block against the current file, if it is being profiled
+    if __current__ is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        if __current__ is not None:
+            __current__[name] = __current__.get(name, 0) + time.time() - start
+
+def drain():
+    # records finished since the last call, to be returned to the parent
+    global __records__
+    records, __records__ = __records__, []
+    return records
+
+class TimingReport(object):
+    # aggregates per-file records in the parent and optionally streams them to a trace file
+    # the trace is CSV if its name ends in .csv, otherwise one JSON object per line
+
+    def __init__(self, traceFile=None):
+        self.traceFile = traceFile
+        self.handle = None
+        self.totals = dict([(name, 0.0) for name in __stages__])
+        self.counts = dict([(name, 0) for name in __stages__])
+        self.maxima = dict([(name, 0.0) for name in __stages__])
+        if traceFile is not None:
+            self.handle = open(traceFile, 'w')
+            if self.isCSV():
+                self.handle.write(",".join(["file", "pid"] + __file_stages__) + "\n")
+
+    def isCSV(self):
+        return self.traceFile.lower().endswith(".csv")
+
+    def fold(self, name, elapsed):
+        self.totals[name] += elapsed
+        self.counts[name] += 1
+        self.maxima[name] = max(self.maxima[name], elapsed)
+
+    def add(self, records):
+        for record in records:
+            for name in __stages__:
+                if name in record:
+                    self.fold(name, record[name])
+            if self.handle is not None:
+                if self.isCSV():
+                    fields = [record.get("file", ""), str(record.get("pid", ""))]
+                    fields += ["{:.6f}".format(record[name]) if name in record else "" for name in __file_stages__]
+                    self.handle.write(",".join(fields) + "\n")
+                else:
+                    self.handle.write(json.dumps(record) + "\n")
+
+    def time(self, name, iterable):
+        # time spent producing each item of iterable (e.g. finding files), charged to stage name
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.fold(name, time.time() - start)
+                return
+            self.fold(name, time.time() - start)
+            yield item
+
+    def summary(self):
+        # time in the parent (discovery) and in the workers (per file) overlap, so shares are of the workers' total
+        total = self.totals["total"]
+        log("{:<12}{:>8}{:>12}{:>12}{:>12}{:>8}".format("stage", "files", "total (s)", "mean (ms)", "max (ms)", "share"))
+        for name in __stages__:
+            if self.counts[name] == 0:
+                continue
+            count = self.counts[name] if name != "discovery" else self.counts["total"]
+            log("{:<12}{:>8}{:>12.3f}{:>12.2f}{:>12.2f}{:>8}".format(name, count, self.totals[name],
+                1000 * self.totals[name] / max(count, 1), 1000 * self.maxima[name],
+                "{:.1%}".format(self.totals[name] / total) if total > 0 and name != "discovery" else ""))
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
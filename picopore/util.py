@@ -17,14 +17,38 @@
 
 import os
 import numpy as np
+import h5py
 import glob
 import sys
 import re
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    # python < 3.5
+    from scandir import scandir
+
+try:
+    # registers the Blosc and Zstd filters with HDF5
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
 
 def log(message='', end='\n'):
     print(message, end=end)
     sys.stdout.flush()
 
+class ProcessingError(Exception):
+    # a failure already logged and cleaned up by the worker, with the result to count for the file
+    def __init__(self, message, result=0):
+        super(ProcessingError, self).__init__(message)
+        self.result = result
+
+class SkippedFile(Exception):
+    # a file already in the state the worker would produce, left unchanged
+    pass
+
 def getPrefixedFilename(filename, prefix=""):
     if prefix is None or prefix == "":
         return filename
@@ -33,18 +57,32 @@ def getPrefixedFilename(filename, prefix=""):
     else:
         return os.path.join(os.path.dirname(filename), ".".join([prefix, os.path.basename(filename)]))
 
-def recursiveFindFast5(inp, skip_root=False, depth=0):
-    files = []
+def scanFast5(directory, skip_root=False, depth=1):
+    # DirEntry caches the file type, so no further stat calls are needed
+    for entry in scandir(directory):
+        if entry.is_dir():
+            for path in scanFast5(entry.path, skip_root, depth+1):
+                yield path
+        elif (not skip_root or depth > 1) and entry.is_file() and entry.name.endswith(".fast5"):
+            yield entry.path
+
+def findFast5(inp, skip_root=False):
+    # generator, so that files can be processed while the search continues
+    found = False
     for path in inp:
         if os.path.isdir(path):
-            files.extend(recursiveFindFast5([os.path.join(path, i) for i in os.listdir(path)], skip_root, depth+1))
-        elif (not skip_root or depth > 1) and os.path.isfile(path) and path.endswith(".fast5"):
-            files.append(path)
+            paths = scanFast5(path, skip_root)
+        elif not skip_root and os.path.isfile(path) and path.endswith(".fast5"):
+            paths = [path]
         elif not skip_root:
-            files.extend(glob.glob("{}*.fast5".format(path)))
-    if depth == 0 and len(files) == 0:
+            paths = glob.glob("{}*.fast5".format(path))
+        else:
+            paths = []
+        for path in paths:
+            found = True
+            yield path
+    if not found:
         log("No files found under {}".format(', '.join(inp)))
-    return files
 
 def isType(obj, types):
     try:
@@ -96,17 +134,43 @@ def getIntDtype(num):
         name='int64'
     return name
 
+def getArrayDtype(data):
+    # vectorised typing of numpy arrays, equivalent to typing element by element
+    kind = data.dtype.kind
+    if data.size == 0:
+        name=data.dtype
+    elif kind in 'iu':
+        low, high = int(data.min()), int(data.max())
+        if low > 0:
+            name=getUIntDtype(high)
+        else:
+            name=getIntDtype(max(abs(low), high))
+    elif kind in 'SU':
+        name='|S{}'.format(max(int(np.char.str_len(np.asarray(data)).max()),1))
+    elif kind == 'b':
+        name='bool'
+    elif kind == 'f':
+        name=data.dtype.name
+    else:
+        # object arrays (e.g. variable length strings) must be typed by element
+        return getElementDtype(data)
+    return np.dtype(name)
+
+def getElementDtype(data):
+    if isInt(data[0]):
+        if min(data) > 0:
+            name=getUIntDtype(max(data))
+        else:
+            name=getIntDtype(max(abs(min(data)), max(data)))
+    elif isStr(data[0]):
+        name='|S{}'.format(max(max([len(i) for i in data]),1))
+    else:
+        name=getDtype(data[0])
+    return np.dtype(name)
+
 def getDtype(data):
     if isArray(data):
-        if isInt(data[0]):
-            if min(data) > 0:
-                name=getUIntDtype(max(data))
-            else:
-                name=getIntDtype(max(data))
-        elif isStr(data[0]):
-            name='|S{}'.format(max(max([len(i) for i in data]),1))
-        else:
-            name=getDtype(data[0])
+        return getArrayDtype(np.asanyarray(data))
     elif isInt(data):
         if data > 0:
             name=getUIntDtype(data)
@@ -122,6 +186,20 @@ def getDtype(data):
         return None
     return np.dtype(name)
 
+def rewriteFields(data, names, columns, dtypes=None, drop=[]):
+    # equivalent to append_fields(drop_fields(data, drop + names), names, columns, dtypes)
+    # but builds the new structured array in a single allocation
+    if dtypes is None:
+        dtypes = [np.asarray(column).dtype for column in columns]
+    keep = [name for name in data.dtype.names if name not in names and name not in drop]
+    newtype = [(name, data.dtype[name]) for name in keep] + list(zip(names, dtypes))
+    newData = np.empty(data.shape, dtype=newtype)
+    for name in keep:
+        newData[name] = data[name]
+    for name, column in zip(names, columns):
+        newData[name] = column
+    return newData
+
 def recursiveFindDatasets(group, keyword, match_child):
     eventPaths = []
     if isGroup(group):
@@ -146,6 +224,77 @@ def findDatasets(f, group_id="all", keyword="Events", entry_point="Analyses", ma
         pass
     return eventPaths
 
+def compileKeywords(keywords):
+    # a single pattern matching any of the keywords
+    if len(keywords) == 1:
+        return re.compile(keywords[0])
+    return re.compile("|".join(["(?:{})".format(kw) for kw in keywords]))
+
+class HDF5Index(object):
+    # a single traversal of an HDF5 file, answering findDatasets queries from memory
+    # the index must be rebuilt if groups or datasets are moved or deleted
+
+    def __init__(self, f):
+        self.file = f
+        self.kinds = {"/" : "Group"}
+        self.parents = {}
+        self.children = {"/" : []}
+        f.visititems(self.add)
+
+    def add(self, name, obj):
+        path = "/" + name
+        parent = path.rsplit("/", 1)[0] or "/"
+        self.kinds[path] = type(obj).__name__
+        self.parents[path] = parent
+        self.children[parent].append(path)
+        if isGroup(obj):
+            self.children[path] = []
+
+    def parent(self, path, depth=1):
+        for _ in range(depth):
+            path = self.parents[path]
+        return path
+
+    def attrs(self, path):
+        return self.file[path].attrs
+
+    def walk(self, path):
+        # children before parents, as in recursiveFindDatasets
+        for child in self.children.get(path, []):
+            for subpath in self.walk(child):
+                yield subpath
+        yield path
+
+    def groups(self, group_id, entry_point):
+        if isinstance(entry_point, bytes):
+            entry_point = entry_point.decode()
+        entry_point = "/" + entry_point.strip("/")
+        return [group for group in self.children.get(entry_point, []) if group_id == "all" or group.endswith(group_id)]
+
+    def find(self, group_id="all", keyword="Events", entry_point="Analyses", match_child=False):
+        eventPaths = []
+        for group in self.groups(group_id, entry_point):
+            for path in self.walk(group):
+                name = path.split("/")[-1] if match_child else path
+                if re.search(keyword, name) is not None:
+                    eventPaths.append(path)
+        return eventPaths
+
+    def prune(self, path, keyword):
+        # matching paths, parents before children, skipping the descendants of a match
+        if re.search(keyword, path) is not None:
+            return [path]
+        eventPaths = []
+        for child in self.children.get(path, []):
+            eventPaths.extend(self.prune(child, keyword))
+        return eventPaths
+
+    def findOutermost(self, group_id="all", keyword="Events", entry_point="Analyses"):
+        eventPaths = []
+        for group in self.groups(group_id, entry_point):
+            eventPaths.extend(self.prune(group, keyword))
+        return eventPaths
+
 def rewriteDataset(f, path, compression="gzip", compression_opts=1, dataset=None):
     obj = f.get(path)
     if not isDataset(obj):
@@ -153,6 +302,9 @@ def rewriteDataset(f, path, compression="gzip", compression_opts=1, dataset=None
     attrs = obj.attrs
     dataset = obj.value if dataset is None else dataset
     del f[path]
+    if f.file.driver == "core":
+        # in-memory image: filters are applied when the image is written out
+        compression, compression_opts = None, None
     try:
         cols = dataset.dtype.names
         if cols is None:
@@ -171,22 +323,34 @@ def rewriteDataset(f, path, compression="gzip", compression_opts=1, dataset=None
     for name, value in attrs.items():
         f[path].attrs[name] = value
 
+def escapeName(name):
+    # collapsed paths are joined with ".", so names containing "." (e.g. post_processing.4000Hz) are escaped
+    # names without "%" are unchanged by unescaping, so files collapsed before escaping still uncollapse
+    return name.replace("%", "%25").replace(".", "%2E")
+
+def unescapeName(name):
+    return name.replace("%2E", ".").replace("%25", "%")
+
+def splitCollapsedName(name):
+    return [unescapeName(part) for part in name.split(".")]
+
 def recursiveCollapseGroups(f, basegroup, path, group):
+    # path is the collapsed name of group, escaped with escapeName
     for subname, object in group.items():
-        subpath = "{}.{}".format(path, subname)
+        subpath = "{}.{}".format(path, escapeName(subname))
         if isGroup(object):
             recursiveCollapseGroups(f, basegroup, subpath, object)
         else:
             f.move(object.name, "{}/{}".format(basegroup, subpath))
     for k, v in group.attrs.items():
-        f[basegroup].attrs.create("{}.{}".format(path, k), v, dtype=getDtype(v))
+        f[basegroup].attrs.create("{}.{}".format(path, escapeName(k)), v, dtype=getDtype(v))
     del f[group.name]
 
 def uncollapseGroups(f, basegroup):
     for name, object in basegroup.items():
-        f.move("{}/{}".format(basegroup.name, name), name.replace(".", "/")) # TODO: does this include basegroup?
+        f.move("{}/{}".format(basegroup.name, name), "/".join(splitCollapsedName(name))) # TODO: does this include basegroup?
     for k, v in basegroup.attrs.items():
-        k = k.split(".")
+        k = splitCollapsedName(k)
         groupname = "/".join(k[:-1])
         attrname = k[-1]
         try:
@@ -198,3 +362,197 @@ def uncollapseGroups(f, basegroup):
                 raise e
         f[groupname].attrs.create(attrname, v, dtype=getDtype(v))
     del f[basegroup.name]
+
+def getFilterOpts(filtr):
+    # translate a comma separated filter string (e.g. SHUF,GZIP=9) into create_dataset arguments
+    # GZIP, SHUF and NONE follow h5repack; LZF, ZSTD and BLOSC are h5py / hdf5plugin filters
+    opts = {}
+    for name in filtr.split(","):
+        name, _, value = name.partition("=")
+        name = name.strip().upper()
+        if name == "GZIP":
+            opts.update(compression="gzip", compression_opts=int(value))
+        elif name == "LZF":
+            opts.update(compression="lzf")
+        elif name == "SHUF":
+            opts.update(shuffle=True)
+        elif name in ["ZSTD", "BLOSC"]:
+            if hdf5plugin is None:
+                raise ValueError("Filter {} requires hdf5plugin, which is not installed".format(name))
+            elif name == "ZSTD":
+                opts.update(hdf5plugin.Zstd(clevel=int(value) if value else 3))
+            else:
+                opts.update(hdf5plugin.Blosc(cname='zstd', clevel=int(value) if value else 5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+        elif name != "NONE":
+            raise ValueError("Filter {} not recognised".format(name))
+    return opts
+
+__adaptive_filters__ = {}
+__adaptive_sample_size__ = 2**20
+# (dict, lock) shared by all workers of a run, so each class of dataset is trialled once
+__adaptive_shared__ = None
+
+def isAdaptive(filtr):
+    return filtr.strip().upper() == "ADAPTIVE"
+
+def checkFilter(filtr):
+    # raises ValueError if filtr can't be used here
+    if not isAdaptive(filtr):
+        getFilterOpts(filtr)
+
+def getCandidateFilters():
+    candidates = ["GZIP=9", "SHUF,GZIP=9", "GZIP=4", "SHUF,GZIP=4", "LZF", "SHUF,LZF"]
+    if hdf5plugin is not None:
+        candidates.extend(["ZSTD=3", "SHUF,ZSTD=3", "BLOSC=5"])
+    return candidates
+
+def getDatasetClass(path):
+    # datasets differing only by read, channel or analysis number compress alike
+    return re.sub("[0-9]+", "*", path)
+
+def trialCompress(data, filtr):
+    # stored size and write time of data with filtr, in an in-memory file
+    with h5py.File("picopore.trial", 'w', driver='core', backing_store=False) as f:
+        start = time.time()
+        dataset = f.create_dataset("trial", data=data, chunks=True, **getFilterOpts(filtr))
+        f.flush()
+        elapsed = time.time() - start
+        return dataset.id.get_storage_size(), elapsed
+
+def setAdaptiveShared(filters, lock):
+    global __adaptive_shared__
+    __adaptive_shared__ = (filters, lock)
+
+def chooseAdaptiveFilter(dataset):
+    # trial compress a sample of the first dataset of each class and keep the smallest for the rest of the run
+    datasetClass = getDatasetClass(dataset.name)
+    if datasetClass not in __adaptive_filters__:
+        if dataset.size == 0 or dataset.shape is None or len(dataset.shape) == 0:
+            return "GZIP=9"
+        if __adaptive_shared__ is None:
+            __adaptive_filters__[datasetClass] = trialAdaptiveFilter(dataset, datasetClass)
+        else:
+            filters, lock = __adaptive_shared__
+            # other workers wait for the first to finish its trial, rather than run their own
+            with lock:
+                if datasetClass not in filters:
+                    filters[datasetClass] = trialAdaptiveFilter(dataset, datasetClass)
+                __adaptive_filters__[datasetClass] = filters[datasetClass]
+    return __adaptive_filters__[datasetClass]
+
+def trialAdaptiveFilter(dataset, datasetClass):
+    # the smallest output of each candidate filter chain on a sample of dataset
+    rows = max(1, __adaptive_sample_size__ // max(1, dataset.dtype.itemsize * (dataset.size // dataset.shape[0])))
+    sample = dataset[:rows]
+    trials = []
+    for filtr in getCandidateFilters():
+        size, elapsed = trialCompress(sample, filtr)
+        trials.append((size, elapsed, filtr))
+    size, elapsed, filtr = min(trials)
+    log("Adaptive codec for {}: {} ({})".format(datasetClass, filtr, ", ".join(["{} {:.1%} {:.1f}MB/s".format(
+        trialFiltr, float(trialSize) / sample.nbytes, sample.nbytes / max(trialElapsed, 1e-6) / 2**20) for trialSize, trialElapsed, trialFiltr in trials])))
+    return filtr
+
+def getH5repackArgs(filtr):
+    args = []
+    for name in filtr.split(","):
+        if name.partition("=")[0].strip().upper() not in ["GZIP", "SHUF", "NONE"]:
+            raise ValueError("Filter {} not supported by h5repack".format(name))
+        args.extend(["-f", name])
+    return args
+
+def copyAttrs(src, dst):
+    for name in src.attrs.keys():
+        # preserve the stored type, rather than the type h5py would infer
+        dst.attrs.create(name, src.attrs[name], dtype=src.attrs.get_id(name).dtype)
+
+def parseSize(size):
+    # a size in bytes, with an optional K, M or G suffix
+    size = size.strip().upper()
+    multiplier = {"K": 2**10, "M": 2**20, "G": 2**30}.get(size[-1:], 1)
+    return int(size[:-1] if multiplier > 1 else size) * multiplier
+
+def getChunkPolicy(policy):
+    # translate a comma separated chunk policy (e.g. Signal=1M,Events=WHOLE,256K) into (keyword, size) pairs
+    # size is AUTO (h5py's guess), WHOLE (one chunk per dataset) or a target chunk size in bytes
+    # the first pair whose keyword is found in a dataset's path applies; a pair without keyword applies to the rest
+    rules = []
+    for rule in policy.split(","):
+        keyword, _, size = rule.rpartition("=")
+        size = size.strip().upper()
+        if size not in ["AUTO", "WHOLE"]:
+            try:
+                size = parseSize(size)
+            except ValueError:
+                raise ValueError("Chunk size {} not recognised".format(rule))
+            if size <= 0:
+                raise ValueError("Chunk size {} must be positive".format(rule))
+        rules.append((keyword.strip() if keyword else None, size))
+    return rules
+
+def getChunks(dataset, chunkPolicy=None):
+    size = "AUTO"
+    for keyword, ruleSize in getChunkPolicy(chunkPolicy) if chunkPolicy is not None else []:
+        if keyword is None or re.search(keyword, dataset.name) is not None:
+            size = ruleSize
+            break
+    if dataset.size == 0:
+        # h5py's guess; an empty dataset's own chunks may exceed its shape
+        return True
+    if size == "AUTO":
+        return True if dataset.chunks is None else dataset.chunks
+    rows = dataset.shape[0]
+    if size != "WHOLE":
+        # chunks span whole rows, so that sequential reads decompress each chunk once
+        rowSize = dataset.dtype.itemsize * (dataset.size // dataset.shape[0])
+        rows = min(rows, max(1, size // rowSize))
+    return (rows,) + dataset.shape[1:]
+
+def copyDataset(src, dst, name, chunkPolicy=None, **filterOpts):
+    if src.shape is None or len(src.shape) == 0:
+        # scalar datasets don't support chunk/filter options
+        filterOpts = {}
+    elif len(filterOpts) > 0:
+        filterOpts["chunks"] = getChunks(src, chunkPolicy)
+        if src.size > 0:
+            # h5py guesses chunks larger than an empty dataset's shape, so only a shape that can grow would fit them
+            filterOpts["maxshape"] = src.maxshape
+    dst.create_dataset(name, data=src[()], dtype=src.dtype, **filterOpts)
+    copyAttrs(src, dst[name])
+
+def copyTree(src, dst, chooseFilter, chunkPolicy=None):
+    # chooseFilter returns the filter string for each dataset
+    copyAttrs(src, dst)
+    for name in src.keys():
+        link = src.get(name, getlink=True)
+        if isType(link, ["SoftLink"]):
+            dst[name] = h5py.SoftLink(link.path)
+        elif isType(link, ["ExternalLink"]):
+            dst[name] = h5py.ExternalLink(link.filename, link.path)
+        elif isGroup(src[name]):
+            copyTree(src[name], dst.create_group(name), chooseFilter, chunkPolicy)
+        else:
+            copyDataset(src[name], dst, name, chunkPolicy, **getFilterOpts(chooseFilter(src[name])))
+
+def copyFile(src, filename, filtr, chunkPolicy=None):
+    if isAdaptive(filtr):
+        chooseFilter = chooseAdaptiveFilter
+    else:
+        chooseFilter = lambda dataset: filtr
+    with h5py.File(filename, 'w') as dst:
+        copyTree(src, dst, chooseFilter, chunkPolicy)
+
+def repack(filename, filtr, src=None, chunkPolicy=None):
+    # in-process equivalent of h5repack -f filtr: copy to a fresh file and replace the original
+    # if src is given (e.g. an edited in-memory image of filename) it is written out instead
+    tmpFilename = "{}.tmp".format(filename)
+    try:
+        if src is None:
+            with h5py.File(filename, 'r') as src:
+                copyFile(src, tmpFilename, filtr, chunkPolicy)
+        else:
+            copyFile(src, tmpFilename, filtr, chunkPolicy)
+        os.rename(tmpFilename, filename)
+    finally:
+        if os.path.isfile(tmpFilename):
+            os.remove(tmpFilename)
@@ -19,7 +19,8 @@ setup(
   packages = ['picopore'],
   package_dir={'picopore': "picopore"},
   version=version,
-  install_requires=['h5py>2.2.0', 'watchdog'],
+  install_requires=['h5py>2.2.0', 'watchdog', 'scandir; python_version < "3.5"'],
+  extras_require={'plugins': ['hdf5plugin']},
   description = 'A tool for reducing the size of Oxford Nanopore Technologies\' datasets without losing information.',
   long_description=read('README.rst'),
   author = 'Scott Gigante',
@@ -36,6 +37,7 @@ setup(
         'console_scripts': ['picopore = picopore.__main__:main',
                             'picopore-rename = picopore.rename:main',
                             'picopore-test = picopore.test:main',
-                            'picopore-realtime = picopore.realtime:main'],
+                            'picopore-realtime = picopore.realtime:main',
+                            'picopore-bench = picopore.bench:main'],
     },
 )
@@ -0,0 +1,116 @@
+import timeit
+import os
+import tempfile
+import h5py
+import numpy as np
+
+from picopore.util import getDtype, getElementDtype, getFilterOpts, copyDataset
+from picopore.compress import matchEvents
+
+__events__ = 100000
+__repeats__ = 5
+__sample_file__ = "sample_data/metrichor_2d_original.fast5"
+__event_detection__ = "Analyses/EventDetection_000/Reads/Read_1209/Events"
+__scale__ = 20
+__signal__ = "Raw/Reads/Read_1209/Signal"
+__chunk_policies__ = ["AUTO", "64K", "256K", "1M", "WHOLE"]
+__read_rows__ = 4096
+
+def eventsColumns(n=__events__):
+    # columns resembling a long read's Events table
+    rand = np.random.RandomState(42)
+    return {
+        "start" : np.cumsum(rand.randint(1, 20, n)).astype('int64'),
+        "length" : rand.randint(1, 200, n).astype('int64'),
+        "move" : rand.randint(0, 3, n).astype('int64'),
+        "offset" : rand.randint(-300, 300, n).astype('int32'),
+        "mean" : rand.normal(90, 10, n),
+        "model_state" : np.array([b"ACGTA", b"CGTAC", b"GTACG"])[rand.randint(0, 3, n)],
+    }
+
+def timeFunc(func, data):
+    return min(timeit.repeat(lambda: func(data), number=1, repeat=__repeats__))
+
+def benchmarkDtype():
+    print("getDtype: {} events, best of {}".format(__events__, __repeats__))
+    print("{:<12}{:>10}{:>14}{:>14}{:>10}".format("column", "dtype", "element (s)", "array (s)", "speedup"))
+    for name, data in sorted(eventsColumns().items()):
+        old = timeFunc(getElementDtype, data)
+        new = timeFunc(getDtype, data)
+        assert getElementDtype(data) == getDtype(data)
+        print("{:<12}{:>10}{:>14.5f}{:>14.5f}{:>9.1f}x".format(name, str(getDtype(data)), old, new, old/new))
+
+def matchEventsLoop(eventData, start):
+    # element by element matching, as used before matchEvents
+    i=0
+    keepIndex = []
+    for time in start:
+        while eventData["start"][i] != time and i < eventData.shape[0]:
+            i += 1
+        keepIndex.append(i)
+    return eventData[keepIndex]
+
+def scaledEventDetection(filename=__sample_file__, path=__event_detection__, scale=__scale__):
+    # tile the sample event detection table end to end to simulate a long read
+    with h5py.File(filename, 'r') as f:
+        eventData = f[path][()]
+    offset = eventData["start"][-1] + eventData["length"][-1]
+    eventData = np.concatenate([eventData] * scale)
+    eventData["start"] += np.repeat(np.arange(scale) * offset, eventData.shape[0] // scale)
+    return eventData
+
+def benchmarkMatchEvents():
+    eventData = scaledEventDetection()
+    # basecalled events are a sorted subset of event detection
+    keep = np.sort(np.random.RandomState(42).choice(eventData.shape[0], eventData.shape[0] * 3 // 5, replace=False))
+    start = eventData["start"][keep]
+    old = timeFunc(lambda s: matchEventsLoop(eventData, s), start)
+    new = timeFunc(lambda s: matchEvents(eventData, s), start)
+    assert (matchEventsLoop(eventData, start) == matchEvents(eventData, start)).all()
+    print("matchEvents: {} events, {} basecalled, best of {}".format(eventData.shape[0], start.shape[0], __repeats__))
+    print("{:>14}{:>14}{:>10}".format("loop (s)", "array (s)", "speedup"))
+    print("{:>14.5f}{:>14.5f}{:>9.1f}x".format(old, new, old/new))
+
+def scaledSignal(filename=__sample_file__, path=__signal__, scale=__scale__):
+    with h5py.File(filename, 'r') as f:
+        return np.tile(f[path][()], scale)
+
+def readAll(dataset):
+    return dataset[()]
+
+def readSequential(dataset):
+    # downstream tools commonly stream a dataset in blocks of rows
+    for i in range(0, dataset.shape[0], __read_rows__):
+        dataset[i:i + __read_rows__]
+
+def benchmarkChunks(filtr="GZIP=9"):
+    print("chunk policy: {}, best of {}".format(filtr, __repeats__))
+    print("{:<10}{:>8}{:>12}{:>10}{:>12}{:>14}{:>14}".format("dataset", "policy", "chunks", "ratio", "write (s)", "read (MB/s)", "blocks (MB/s)"))
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, "chunks.hdf5")
+    try:
+        for name, data in [("Signal", scaledSignal()), ("Events", scaledEventDetection())]:
+            with h5py.File("benchmark.src", 'w', driver='core', backing_store=False) as src:
+                src.create_dataset(name, data=data)
+                for policy in __chunk_policies__:
+                    def write(data):
+                        with h5py.File(filename, 'w') as dst:
+                            copyDataset(src[name], dst, name, policy, **getFilterOpts(filtr))
+                    writeTime = timeFunc(write, data)
+                    with h5py.File(filename, 'r') as dst:
+                        dataset = dst[name]
+                        chunks = dataset.chunks[0]
+                        ratio = float(dataset.id.get_storage_size()) / data.nbytes
+                        readTime = timeFunc(readAll, dataset)
+                        blockTime = timeFunc(readSequential, dataset)
+                    print("{:<10}{:>8}{:>12}{:>10.3f}{:>12.4f}{:>14.1f}{:>14.1f}".format(name, policy, chunks, ratio, writeTime,
+                          data.nbytes / readTime / 2**20, data.nbytes / blockTime / 2**20))
+    finally:
+        if os.path.isfile(filename):
+            os.remove(filename)
+        os.rmdir(tmpdir)
+
+if __name__ == "__main__":
+    benchmarkDtype()
+    benchmarkMatchEvents()
+    benchmarkChunks()